@@ -0,0 +1,200 @@
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import requests
+
+
+class AlignmentCache:
+    """
+    Persistent cache of alignment results in an SQLite file, keyed by the
+    hash of the audio, the normalized transcript and the aligner version.
+    Least recently used results are evicted once the cached results take
+    more than `max_size` bytes.
+
+    Lookups don't write: a hit refreshes last_used at most once every
+    TOUCH_INTERVAL seconds, and refreshes are kept in memory until the next
+    put(), close() or TOUCH_BATCH of them.
+    """
+    TOUCH_INTERVAL = 3600
+    TOUCH_BATCH = 256
+
+    def __init__(self, filename, max_size):
+        self.__max_size = max_size
+        self.__unchecked = 0
+        self.__touched = {}
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(filename, timeout=60,
+            check_same_thread=False)
+        self.__connection.execute('PRAGMA journal_mode = WAL')
+        self.__connection.execute("""CREATE TABLE IF NOT EXISTS alignment (
+            key CHAR(64) PRIMARY KEY,
+            result TEXT NOT NULL,
+            size INT NOT NULL,
+            last_used REAL NOT NULL
+        )""")
+        self.__connection.execute(
+            'CREATE INDEX IF NOT EXISTS alignment_last_used ON alignment (last_used)')
+        self.__connection.commit()
+
+    @staticmethod
+    def make_key(wav_data, transcript, version):
+        digest = hashlib.sha256(wav_data)
+        digest.update(b'\0' + ' '.join(transcript.lower().split()).encode('utf-8'))
+        digest.update(b'\0' + version.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT result, last_used FROM alignment WHERE key = ?',
+                [key]).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] > self.TOUCH_INTERVAL:
+                self.__touched[key] = now
+                if len(self.__touched) >= self.TOUCH_BATCH:
+                    self.__write_touched()
+                    self.__connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        data = json.dumps(result)
+        with self.__lock:
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO alignment (key, result, size, last_used) VALUES (?, ?, ?, ?)',
+                [key, data, len(data), time.time()])
+            self.__unchecked += len(data)
+            self.__write_touched()
+            if self.__unchecked > self.__max_size // 100:
+                self.__evict()
+                self.__unchecked = 0
+            self.__connection.commit()
+
+    def close(self):
+        with self.__lock:
+            self.__write_touched()
+            self.__connection.commit()
+        self.__connection.close()
+
+    def __write_touched(self):
+        if not self.__touched:
+            return
+        self.__connection.executemany(
+            'UPDATE alignment SET last_used = ? WHERE key = ?',
+            ((used, key) for key, used in self.__touched.items()))
+        self.__touched = {}
+
+    def __evict(self):
+        total = self.__connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM alignment').fetchone()[0]
+        if total <= self.__max_size:
+            return
+        excess = total - self.__max_size * 9 // 10
+        keys = []
+        cursor = self.__connection.execute(
+            'SELECT key, size FROM alignment ORDER BY last_used ASC')
+        for key, size in cursor:
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        cursor.close()
+        self.__connection.executemany('DELETE FROM alignment WHERE key = ?',
+            keys)
+
+
+class AlignerClient:
+    """
+    Client for a Gentle compatible forced alignment service. Connections
+    are kept alive and reused, up to `concurrency` requests are sent at the
+    same time, and failed requests are retried with exponential backoff.
+    Results are looked up in and added to `cache` if one is given.
+    """
+    def __init__(self, url, concurrency=4, timeout=60, retries=3,
+            backoff=1.0, cache: AlignmentCache = None, version=''):
+        self.__url = url + '/transcriptions?async=false'
+        self.__cache = cache
+        self.__version = version
+        self.__concurrency = concurrency
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__local = threading.local()
+        self.__executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+
+    def align(self, wav_data, transcript):
+        """
+        Align a transcript against a WAV file, returning the service's
+        JSON result.
+        """
+        if self.__cache is not None:
+            key = AlignmentCache.make_key(wav_data, transcript, self.__version)
+            result = self.__cache.get(key)
+            if result is None:
+                result = self.__request(wav_data, transcript)
+                self.__cache.put(key, result)
+            return result
+        return self.__request(wav_data, transcript)
+
+    def __request(self, wav_data, transcript):
+        files = {
+            'audio': ('audio.wav', wav_data, 'audio/wav'),
+            'transcript': ('transcript.txt', transcript)
+        }
+        for attempt in range(self.__retries + 1):
+            try:
+                response = self.__session().post(self.__url, files=files,
+                    timeout=self.__timeout)
+                response.raise_for_status()
+                return response.json()
+            except (requests.RequestException, ValueError):
+                if attempt == self.__retries:
+                    raise
+                delay = self.__backoff * 2 ** attempt
+                logging.warning('Alignment request failed, retrying in %.1fs',
+                    delay, exc_info=True)
+                time.sleep(delay)
+
+    def align_many(self, jobs):
+        """
+        Align every (wav_data, transcript) pair from the `jobs` iterable
+        concurrently, yielding the results in the same order. A job whose
+        request still fails after all retries yields None instead of failing
+        the others. Only a few jobs are taken from `jobs` ahead of the
+        results being consumed.
+        """
+        pending = collections.deque()
+        for wav_data, transcript in jobs:
+            if len(pending) >= 2 * self.__concurrency:
+                yield self.__result(pending.popleft())
+            pending.append(
+                self.__executor.submit(self.align, wav_data, transcript))
+        while pending:
+            yield self.__result(pending.popleft())
+
+    def __result(self, future):
+        try:
+            return future.result()
+        except (requests.RequestException, ValueError):
+            logging.warning('Alignment failed after %d retries, skipping it',
+                self.__retries, exc_info=True)
+            return None
+
+    def close(self):
+        self.__executor.shutdown()
+        if self.__cache is not None:
+            self.__cache.close()
+
+    def __session(self):
+        session = getattr(self.__local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self.__local.session = session
+        return session
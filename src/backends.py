@@ -0,0 +1,250 @@
+"""
+Downloader backends of the crawler. A backend opens downloader instances
+with the interface of youtube_dl.YoutubeDL, and fetches the URLs found in
+their info dicts, e.g. subtitles, for the pre-screen.
+
+The replay backend serves a fixture directory instead of YouTube, so that
+whole crawls can be run and timed on an isolated machine:
+
+    DIRECTORY/search/QUERY.json         video ids of every search result
+                                        page, [[id, ...], [id, ...], ...]
+    DIRECTORY/channels/CHANNEL_ID.json  video ids of the channel uploads,
+                                        [id, ...]
+    DIRECTORY/videos/ID.info.json       info dict, as written by youtube_dl
+    DIRECTORY/videos/ID.LANG.vtt|ttml   subtitles
+    DIRECTORY/videos/ID.m4a             audio
+
+where QUERY is quoted with urllib.parse.quote(query, safe='').
+"""
+
+import email.message
+import glob
+import io
+import json
+import os
+import threading
+import time
+import urllib.parse
+import urllib.request
+import urllib.response
+
+import youtube_dl
+from youtube_dl.utils import url_basename
+
+
+def own_playlist_urls(youtube):
+    """
+    youtube_dl keeps the URLs of the playlists being downloaded in a class
+    attribute, and skips a playlist found in it, so two instances
+    downloading items of the same channel at the same time would skip it.
+    """
+    youtube._playlist_urls = set()
+    return youtube
+
+
+class YoutubeDLBackend:
+    def open(self, options):
+        return own_playlist_urls(youtube_dl.YoutubeDL(options))
+
+    def urlopen(self, url, timeout=None):
+        return urllib.request.urlopen(url, timeout=timeout)
+
+
+class ThrottledFile(io.RawIOBase):
+    def __init__(self, f, backend):
+        super().__init__()
+        self.__file = f
+        self.__backend = backend
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.__file.readinto(buffer)
+        self.__backend.transfer(count)
+        return count
+
+    def close(self):
+        self.__file.close()
+        super().close()
+
+
+class ReplayBackend:
+    """
+    Serve the fixtures in `directory`. Every request waits `latency`
+    seconds, and all transfers share a link of `bandwidth` bytes per
+    second, unlimited if None.
+    """
+    SCHEME = 'replay'
+    # Fields of recorded info dicts describing the downloaded format, which
+    # are replaced by the fixture files.
+    DOWNLOAD_FIELDS = ('formats', 'requested_formats', 'requested_subtitles',
+        'subtitles', 'automatic_captions', 'url', 'ext', 'format',
+        'format_id', 'protocol', 'http_headers', '_filename')
+
+    def __init__(self, directory, latency=0.0, bandwidth=None):
+        self.__directory = directory
+        self.__latency = latency
+        self.__bandwidth = bandwidth
+        self.__lock = threading.Lock()
+        self.__link_free = 0.0
+
+    def open(self, options):
+        return own_playlist_urls(ReplayDownloader(self, options))
+
+    def urlopen(self, url, timeout=None):
+        if not url.startswith(self.SCHEME + ':'):
+            raise ValueError(f'Not a replay URL: {url}')
+        self.request()
+        filename = os.path.join(self.__directory,
+            urllib.parse.unquote(url[len(self.SCHEME) + 1:]))
+        f = open(filename, 'rb')
+        headers = email.message.Message()
+        headers['Content-Length'] = str(os.fstat(f.fileno()).st_size)
+        return urllib.response.addinfourl(ThrottledFile(f, self), headers,
+            url, 200)
+
+    def request(self):
+        if self.__latency > 0:
+            time.sleep(self.__latency)
+
+    def transfer(self, size):
+        """
+        Wait until `size` bytes went through the link.
+        """
+        if not self.__bandwidth or not size:
+            return
+        with self.__lock:
+            now = time.monotonic()
+            self.__link_free = max(now, self.__link_free) \
+                + size / self.__bandwidth
+            end = self.__link_free
+        time.sleep(max(0.0, end - now))
+
+    def extract(self, url):
+        """
+        Return the youtube_dl result of a search result page, channel
+        uploads or video URL.
+        """
+        parts = urllib.parse.urlsplit(url)
+        query = urllib.parse.parse_qs(parts.query)
+        self.request()
+        if parts.path == '/results':
+            return self.__search_page(query['q'][0],
+                int(query.get('p', ['1'])[0]), url)
+        if parts.path == '/watch':
+            return self.__video(query['v'][0], url)
+        path = parts.path.split('/')
+        if len(path) == 4 and path[1] == 'channel' and path[3] == 'videos':
+            return self.__channel(path[2], url)
+        raise ValueError(f'Cannot replay {url}')
+
+    @staticmethod
+    def __playlist(playlist_id, video_ids, url, extractor, extractor_key):
+        return {
+            '_type': 'playlist', 'id': playlist_id, 'title': playlist_id,
+            'extractor': extractor, 'extractor_key': extractor_key,
+            'webpage_url': url, 'webpage_url_basename': url_basename(url),
+            'entries': [{
+                '_type': 'url', 'ie_key': 'Youtube', 'id': video_id,
+                'url': f'https://www.youtube.com/watch?v={video_id}',
+            } for video_id in video_ids],
+        }
+
+    def __read_json(self, *path, default):
+        try:
+            with open(os.path.join(self.__directory, *path)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+
+    def __channel(self, channel_id, url):
+        video_ids = self.__read_json('channels',
+            urllib.parse.quote(channel_id, safe='') + '.json', default=[])
+        return self.__playlist(channel_id, video_ids, url, 'youtube:tab',
+            'YoutubeTab')
+
+    def __search_page(self, query, page, url):
+        pages = self.__read_json('search',
+            urllib.parse.quote(query, safe='') + '.json', default=[])
+        video_ids = pages[page - 1] if page <= len(pages) else []
+        return self.__playlist(query, video_ids, url, 'youtube:search_url',
+            'YoutubeSearchURL')
+
+    def __video(self, video_id, url):
+        base = os.path.join('videos', video_id)
+        with open(os.path.join(self.__directory, base + '.info.json')) as f:
+            info = json.load(f)
+        for field in self.DOWNLOAD_FIELDS:
+            info.pop(field, None)
+        info.setdefault('title', video_id)
+        info.update({
+            'id': video_id, 'extractor': 'youtube',
+            'extractor_key': 'Youtube', 'webpage_url': url,
+            'webpage_url_basename': url_basename(url), 'formats': [],
+            'subtitles': {},
+        })
+        if os.path.isfile(os.path.join(self.__directory, base + '.m4a')):
+            info['formats'].append({
+                'format_id': self.SCHEME, 'ext': 'm4a',
+                'url': self.__url(base + '.m4a'),
+                'acodec': 'mp4a.40.2', 'vcodec': 'none',
+            })
+        pattern = glob.escape(os.path.join(self.__directory, base)) + '.*.*'
+        for filename in sorted(glob.glob(pattern)):
+            name = os.path.basename(filename)
+            lang, ext = name[len(video_id) + 1:].rsplit('.', 1)
+            if ext in ('vtt', 'ttml'):
+                info['subtitles'].setdefault(lang, []).append(
+                    {'ext': ext, 'url': self.__url(os.path.join('videos', name))})
+        return info
+
+    def __url(self, path):
+        return f'{self.SCHEME}:{urllib.parse.quote(path)}'
+
+
+class ReplayDownloader(youtube_dl.YoutubeDL):
+    """
+    A YoutubeDL taking its info dicts and files from a ReplayBackend. The
+    rest, e.g. the download archive, match filters, output templates and
+    post processors, is left to youtube_dl.
+    """
+    def __init__(self, backend: ReplayBackend, params):
+        super().__init__(params)
+        self.__backend = backend
+
+    def extract_info(self, url, download=True, ie_key=None, extra_info={},
+            process=True, force_generic_extractor=False):
+        try:
+            ie_result = self.__backend.extract(url)
+        except (OSError, ValueError, KeyError) as e:
+            self.report_error(f'Cannot replay {url}: {e}')
+            return None
+        self.add_extra_info(ie_result, extra_info)
+        if not process:
+            return ie_result
+        return self.process_ie_result(ie_result, download, extra_info)
+
+    def urlopen(self, req):
+        url = req if isinstance(req, str) else req.get_full_url()
+        return self.__backend.urlopen(url)
+
+
+def add_backend_options(p):
+    p.add_argument('--backend', default='youtube-dl',
+        choices=('youtube-dl', 'replay'),
+        help='Download from YouTube, or replay the fixtures in '
+            '--replay-dir.')
+    p.add_argument('--replay-dir', help='Fixture directory of --backend replay.')
+    p.add_argument('--replay-latency', type=float, default=0,
+        help='Seconds every replayed request takes before any data.')
+    p.add_argument('--replay-bandwidth', type=float,
+        help='Bytes per second shared by all replayed transfers, unlimited '
+            'by default.')
+
+
+def open_backend(cmdline):
+    if cmdline.backend == 'replay':
+        return ReplayBackend(cmdline.replay_dir, cmdline.replay_latency,
+            cmdline.replay_bandwidth)
+    return YoutubeDLBackend()
@@ -0,0 +1,935 @@
+#!/usr/bin/env python3
+
+import argparse
+import array
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import wave
+
+import dal
+import filter
+import process
+from aligner import AlignerClient
+from fake_aligner import FakeAligner
+from filter import normalizer, youtube_helpers
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def distribution(name, values):
+    """
+    Mean, median, 99th percentile and maximum of `values`, as result
+    entries prefixed with `name`.
+    """
+    return {
+        f'{name}_mean': sum(values) / len(values) if values else 0.0,
+        f'{name}_p50': percentile(values, 50),
+        f'{name}_p99': percentile(values, 99),
+        f'{name}_max': max(values, default=0.0),
+    }
+
+
+def _dal_writer(args):
+    dbfile, writer, cmdline = args
+    database = dal.DataAccessLayer(dbfile, concurrent=cmdline.concurrent,
+        mmap_size=cmdline.mmap_size)
+    latencies = []
+    lock_waits = []
+    executions = []
+    errors = 0
+    for i in range(cmdline.videos):
+        video_id = f'{writer}-{i}'
+        rows = [(f'caption {j} of {video_id}', j * 1000, j * 1000 + 900)
+            for j in range(cmdline.subtitles)]
+        start = time.perf_counter()
+        acquired = None
+        try:
+            with database.transaction(immediate=True):
+                acquired = time.perf_counter()
+                database.add_video(video_id, f'channel-{writer}')
+                database.set_video_length(video_id, cmdline.subtitles * 1000)
+                database.add_subtitles_bulk(video_id, rows)
+        except sqlite3.OperationalError:
+            errors += 1
+        end = time.perf_counter()
+        latencies.append(end - start)
+        lock_waits.append((acquired or end) - start)
+        if acquired is not None:
+            executions.append(end - acquired)
+    return latencies, lock_waits, executions, errors
+
+
+def bench_dal_stress(cmdline):
+    """
+    Write videos and their subtitles from many processes at the same time.
+    Each video is written in one transaction taking the write lock up
+    front: lock_wait is the time spent acquiring it, write the time spent
+    executing and committing the statements, and latency both.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        dbfile = os.path.join(tmp, 'db.sqlite3')
+        dal.DataAccessLayer(dbfile, concurrent=cmdline.concurrent)
+        jobs = [(dbfile, w, cmdline) for w in range(cmdline.writers)]
+        start = time.perf_counter()
+        with multiprocessing.Pool(cmdline.writers) as pool:
+            results = pool.map(_dal_writer, jobs)
+        elapsed = time.perf_counter() - start
+
+    videos = cmdline.writers * cmdline.videos
+    result = {
+        'writers': cmdline.writers,
+        'concurrent': cmdline.concurrent,
+        'videos': videos,
+        'errors': sum(r[3] for r in results),
+        'seconds': elapsed,
+        'videos_per_second': videos / elapsed,
+        'subtitles_per_second': videos * cmdline.subtitles / elapsed,
+    }
+    result.update(distribution('latency', [t for r in results for t in r[0]]))
+    result.update(distribution('lock_wait',
+        [t for r in results for t in r[1]]))
+    result.update(distribution('write', [t for r in results for t in r[2]]))
+    return result
+
+
+SYNTHETIC_WORDS = ('the quick brown fox jumps over the lazy dog while we '
+    'don\'t know what you\'re talking about it\'s 25 percent of 100 people '
+    'really').split()
+
+
+def format_vtt_ts(ms):
+    return '%02d:%02d:%02d.%03d' % (ms // 3600000, ms // 60000 % 60,
+        ms // 1000 % 60, ms % 1000)
+
+
+def write_synthetic_vtt(filename, count, overlap=0.1, seed=0):
+    """
+    Write a WebVTT file with `count` captions, of which about a fraction
+    `overlap` overlap with the caption before them.
+    """
+    rng = random.Random(seed)
+    now = 0
+    with open(filename, 'w') as f:
+        f.write('WEBVTT\n\n')
+        for _ in range(count):
+            start = now + rng.randint(0, 1500)
+            end = start + rng.randint(300, 6000)
+            now = end
+            if rng.random() < overlap:
+                start = max(0, start - rng.randint(500, 3000))
+            words = [rng.choice(SYNTHETIC_WORDS)
+                for _ in range(rng.randint(1, 14))]
+            text = ' '.join(words)
+            if rng.random() < 0.1:
+                text = '[Music] ' + text
+            f.write(f'{format_vtt_ts(start)} --> {format_vtt_ts(end)}\n'
+                f'{text}\n\n')
+
+
+def synthetic_vtt(cmdline, directory):
+    """
+    Return cmdline.file if given, or write a synthetic VTT file into
+    `directory` as set up by add_synthetic_vtt_options().
+    """
+    filename = getattr(cmdline, 'file', None)
+    if filename is None:
+        filename = os.path.join(directory, 'synthetic.en.vtt')
+        write_synthetic_vtt(filename, cmdline.captions, cmdline.overlap,
+            cmdline.seed)
+    return filename
+
+
+def synthetic_pcm(seconds, seed=0):
+    """
+    16 kHz 16-bit mono PCM: a tone changing every second, plus noise.
+    """
+    rng = random.Random(seed)
+    rate = process.AudioData.SAMPLE_RATE * 1000
+    samples = array.array('h')
+    for second in range(int(seconds)):
+        step = 2 * math.pi * rng.randint(100, 1000) / rate
+        samples.extend(int(8000 * math.sin(step * i)) + rng.randint(-500, 500)
+            for i in range(rate))
+    if sys.byteorder != 'little':
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def write_synthetic_wav(filename, seconds, seed=0):
+    with wave.open(filename, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(process.AudioData.SAMPLE_SIZE)
+        f.setframerate(process.AudioData.SAMPLE_RATE * 1000)
+        f.writeframes(synthetic_pcm(seconds, seed))
+
+
+def measure(function, repeat):
+    """
+    Return the best wall time of `repeat` runs, and the peak traced memory
+    and number of allocated blocks of one more traced run.
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        result = function()
+        blocks = sum(stat.count
+            for stat in tracemalloc.take_snapshot().statistics('filename'))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    del result
+    return {'seconds': min(times), 'peak_bytes': peak, 'live_blocks': blocks}
+
+
+def bench_subtitles(cmdline):
+    """
+    Load, remove overlaps and merge subtitles as dicts with datetime.time
+    timestamps, and as Caption objects with integer milliseconds.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = synthetic_vtt(cmdline, tmp)
+
+        def run_dicts():
+            subs = youtube_helpers.load_all_subtitles(filename)
+            subs = youtube_helpers.remove_overlapping_subtitles(subs)
+            return youtube_helpers.merge_subtitles(subs, 1.0, 10)
+
+        def run_captions():
+            subs = youtube_helpers.load_captions(filename)
+            return youtube_helpers.clean_captions(subs, min_dist=1.0,
+                max_dist=10)
+
+        return {
+            'file': cmdline.file,
+            'captions': cmdline.captions,
+            'dicts': measure(run_dicts, cmdline.repeat),
+            'captions_compact': measure(run_captions, cmdline.repeat),
+        }
+
+
+def bench_pipeline(cmdline):
+    """
+    Run the default filter pipeline filter by filter, in batch mode and as
+    a stream, comparing time and peak memory. The normalizer caches are
+    warm after the first run, so they do not count towards peak memory.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = synthetic_vtt(cmdline, tmp)
+        pipeline = filter.filters.default_pipeline()
+
+        def run(mode):
+            def function():
+                if mode == 'stream':
+                    return list(pipeline.stream(
+                        filter.parsers.iter_captions(filename)))
+                data = {'subtitles': youtube_helpers.load_captions(filename)}
+                if mode == 'batch':
+                    return pipeline.batch(data)
+                return pipeline(data)
+            return function
+
+        return {
+            'file': cmdline.file,
+            'captions': cmdline.captions,
+            'filters': measure(run('filters'), cmdline.repeat),
+            'batch': measure(run('batch'), cmdline.repeat),
+            'stream': measure(run('stream'), cmdline.repeat),
+        }
+
+
+VTT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, 'testdata', 'vtt')
+
+
+def parse_outcome(load, filename):
+    """
+    The captions `load` returns for `filename`, or the name of the error it
+    raises, for comparing parsers on malformed files as well.
+    """
+    try:
+        return load(filename)
+    except Exception as e:
+        return type(e).__name__
+
+
+def vtt_fixtures():
+    return sorted(os.path.join(VTT_FIXTURES, name)
+        for name in os.listdir(VTT_FIXTURES) if name.endswith('.vtt'))
+
+
+def load_webvtt(filename):
+    return [filter.Caption.from_dict(sub)
+        for sub in youtube_helpers.load_all_subtitles(filename)]
+
+
+def bench_parser(cmdline):
+    """
+    Check that the streaming VTT parser produces the same captions as
+    webvtt-py, and fails with the same errors, on a corpus of files, and
+    compare their speed. The corpus defaults to the YouTube manual and
+    automatic caption fixtures in testdata/vtt plus a synthetic file.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        files = cmdline.files or vtt_fixtures() + [synthetic_vtt(cmdline, tmp)]
+
+        result = {'files': len(files), 'mismatched_files': [],
+            'failed_files': 0, 'webvtt_seconds': 0.0, 'parser_seconds': 0.0}
+        for filename in files:
+            start = time.perf_counter()
+            expected = parse_outcome(load_webvtt, filename)
+            result['webvtt_seconds'] += time.perf_counter() - start
+            start = time.perf_counter()
+            actual = parse_outcome(youtube_helpers.load_captions, filename)
+            result['parser_seconds'] += time.perf_counter() - start
+            if isinstance(expected, str):
+                result['failed_files'] += 1
+            if actual != expected:
+                result['mismatched_files'].append(
+                    {'file': filename, 'webvtt': repr(expected),
+                        'parser': repr(actual)})
+        return result
+
+
+def random_captions(rng, count):
+    """
+    Random captions with gaps, overlaps, nested and zero length captions.
+    """
+    captions = []
+    now = 0
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.8:
+            start = now + rng.randint(0, 2000)
+        elif kind < 0.95 or not captions:
+            start = max(0, now - rng.randint(0, 3000))
+        else:
+            start = captions[-1].start_ms
+        end = start + (rng.randint(1, 6000) if rng.random() < 0.9 else 0)
+        now = max(now, end)
+        captions.append(filter.Caption(start, end, f'caption {i}', i))
+    return captions
+
+
+def clean_dicts(subs, width, min_dist, max_dist):
+    subs = youtube_helpers.remove_overlapping_subtitles(subs, width)
+    return youtube_helpers.merge_subtitles(subs, min_dist, max_dist)
+
+
+def clean_columns(subs, width, min_dist, max_dist):
+    columns = filter.CaptionColumns.from_captions(subs)
+    bad_indices = youtube_helpers.find_overlapping_captions(columns.start_ms,
+        columns.end_ms, width)
+    columns = columns.compress(
+        [i not in bad_indices for i in range(len(columns))])
+    return youtube_helpers.merge_caption_columns(columns, min_dist,
+        max_dist).to_captions()
+
+
+def outcome(function, *args):
+    try:
+        return function(*args)
+    except AssertionError:
+        return AssertionError
+
+
+def bench_overlap(cmdline):
+    """
+    Check overlap removal and merging of Caption objects against the dict
+    based functions on random caption sequences, and compare their speed.
+    """
+    rng = random.Random(cmdline.seed)
+    result = {'cases': cmdline.cases, 'mismatches': [], 'assertions': 0}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for case in range(cmdline.cases):
+            captions = random_captions(rng, rng.randint(0, 40))
+            width = rng.randint(0, 5)
+            min_dist, max_dist = rng.choice((0.5, 1.0, 1.5)), rng.randint(2, 15)
+            dicts = [c.to_dict() for c in captions]
+            fresh = lambda: [filter.Caption(c.start_ms, c.end_ms, c.text, c.idx)
+                for c in captions]
+
+            expected = [filter.Caption.from_dict(sub) for sub in
+                youtube_helpers.remove_overlapping_subtitles(dicts, width)]
+            if youtube_helpers.remove_overlapping_captions(fresh(), width) \
+                    != expected:
+                result['mismatches'].append({'case': case, 'stage': 'overlap'})
+
+            expected = outcome(clean_dicts, dicts, width, min_dist, max_dist)
+            if expected is AssertionError:
+                result['assertions'] += 1
+            else:
+                expected = [filter.Caption.from_dict(sub) for sub in expected]
+            for name, function in (('clean', youtube_helpers.clean_captions),
+                    ('columns', clean_columns)):
+                actual = outcome(function, fresh(), width, min_dist, max_dist)
+                if actual != expected:
+                    result['mismatches'].append({'case': case, 'stage': name})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = synthetic_vtt(cmdline, tmp)
+        dicts = youtube_helpers.load_all_subtitles(filename)
+        captions = youtube_helpers.load_captions(filename)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        clean_dicts(dicts, 3, 1.0, 10)
+        result['dicts_seconds'] = time.perf_counter() - start
+        start = time.perf_counter()
+        youtube_helpers.clean_captions(captions, 3, 1.0, 10)
+        result['clean_seconds'] = time.perf_counter() - start
+    return result
+
+
+NORMALIZER_PHRASES = [
+    'Hello, world. This is a well-known, up-to-date test.',
+    'JOHN: I don\'t know - what\'s going on?', 'a-b-c-d e--f -g h-',
+    'wait—- what — ever —-- done', 'it\u2019s \u2018quoted\u2019 \u02bbokina\u00b4',
+    'tom&nbsp;and&nbsp;jerry a-&nbsp;b', '<i>italic</i> <c.colorE5E5E5>tag</c>',
+    '[Music] (laughs) *sighs* [a] b [c]', '(unclosed [bracket *star',
+    'caf\u00e9 na\u00efve \ufb01ne \u00b2 \u2026 \u2460 \uff11\uff12',
+    'I have 1 2 3 10 100 1000 007 and 25% of 99 people', '1 10 100 101',
+    'ſtrange K\u212a sign \u0131 \u0130 stra\u00dfe', '  tabs\tand\nnewlines  ',
+    '\u0663 arabic \u0663 digit', '', ' ', '-', '%', 'Mr. Smith: 5 minutes',
+]
+NORMALIZER_ALPHABET = list('aAzZkKsS- \t,.:%\'<>[]()*&;019') + [
+    '\u2014', '\u2019', '\u00b4', '\u017f', '\u212a', '\u00e9',
+    '\u00b2', '\u2026', '&nbsp;', '\u0663', '\u00df', '\u0130']
+
+
+def normalizer_corpus(cmdline, filenames):
+    rng = random.Random(cmdline.seed)
+    corpus = list(NORMALIZER_PHRASES)
+    for _ in range(cmdline.fuzz):
+        corpus.append(''.join(rng.choice(NORMALIZER_ALPHABET)
+            for _ in range(rng.randint(1, 30))))
+    for filename in filenames:
+        corpus.extend(c.text for c in youtube_helpers.load_captions(filename))
+    return corpus
+
+
+def bench_normalizer(cmdline):
+    """
+    Check the compiled normalizer against normalize_subtitle() and
+    leave_alphanum_characters() on a golden corpus of tricky phrases,
+    random strings and subtitle files, and time both.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        files = cmdline.files or [synthetic_vtt(cmdline, tmp)]
+        corpus = normalizer_corpus(cmdline, files)
+
+    legacy = [(youtube_helpers.normalize_subtitle,
+            youtube_helpers.leave_alphanum_characters)]
+    compiled = [(normalizer.normalize.__wrapped__,
+            normalizer.leave_alphanum.__wrapped__)]
+    cached = [(normalizer.normalize, normalizer.leave_alphanum)]
+    mismatches = []
+    for text in corpus:
+        expected = youtube_helpers.normalize_subtitle(text)
+        if normalizer.normalize(text) != expected:
+            mismatches.append({'function': 'normalize', 'text': text})
+        for value in (text, expected):
+            if normalizer.leave_alphanum(value) != \
+                    youtube_helpers.leave_alphanum_characters(value):
+                mismatches.append({'function': 'leave_alphanum',
+                    'text': value})
+
+    def run(functions):
+        normalize, leave_alphanum = functions[0]
+        return lambda: [leave_alphanum(normalize(text)) for text in corpus]
+
+    normalizer.normalize.cache_clear()
+    normalizer.leave_alphanum.cache_clear()
+    return {
+        'phrases': len(corpus),
+        'unique_phrases': len(set(corpus)),
+        'mismatches': mismatches,
+        'legacy': measure(run(legacy), cmdline.repeat),
+        'compiled': measure(run(compiled), cmdline.repeat),
+        'cached': measure(run(cached), cmdline.repeat),
+    }
+
+
+def synthetic_subtitles(count, length_ms=3000, gap_ms=500):
+    subs = []
+    for i in range(count):
+        start = i * (length_ms + gap_ms)
+        subs.append(filter.Caption(start, start + length_ms,
+            f'THIS IS SYNTHETIC CAPTION NUMBER {i}', i))
+    return {'subtitles': subs, 'video_file': ''}
+
+
+def bench_align(cmdline):
+    """
+    Align the same synthetic video per caption and in windows, against a
+    local fake aligner with a fixed per-request latency.
+    """
+    server = FakeAligner(latency=cmdline.latency).start()
+    duration_ms = cmdline.captions * 3500 + 1000
+    audio_data = process.AudioData(
+        bytes(duration_ms * process.AudioData.SAMPLE_RATE
+            * process.AudioData.SAMPLE_SIZE))
+    aligner = AlignerClient(server.url, concurrency=cmdline.concurrency)
+    result = {'captions': cmdline.captions, 'latency': cmdline.latency}
+    try:
+        subtitles = synthetic_subtitles(cmdline.captions)
+        start = time.perf_counter()
+        process.force_align_subtitles(subtitles, aligner, audio_data)
+        result['caption_seconds'] = time.perf_counter() - start
+        result['caption_requests'] = cmdline.captions
+        result['caption_aligned'] = len(subtitles['subtitles'])
+
+        window_ms = int(cmdline.window * 1000)
+        subtitles = synthetic_subtitles(cmdline.captions)
+        requests = len(list(process.split_alignment_windows(
+            subtitles['subtitles'], window_ms)))
+        start = time.perf_counter()
+        process.force_align_windows(subtitles, aligner, audio_data, window_ms)
+        result['window_seconds'] = time.perf_counter() - start
+        result['window_requests'] = requests
+        result['window_aligned'] = len(subtitles['subtitles'])
+    finally:
+        aligner.close()
+        server.shutdown()
+    return result
+
+
+def bench_filter(cmdline):
+    """
+    Load subtitles with webvtt-py into dicts, and load and filter them as
+    process.py does, returning dicts or Caption objects.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = synthetic_vtt(cmdline, tmp)
+        return {
+            'file': cmdline.file,
+            'captions': cmdline.captions,
+            'overlap': cmdline.overlap,
+            'load_all_subtitles': measure(
+                lambda: youtube_helpers.load_all_subtitles(filename),
+                cmdline.repeat),
+            'load_and_filter': measure(
+                lambda: filter.load_and_filter(filename), cmdline.repeat),
+            'load_and_filter_compact': measure(
+                lambda: filter.load_and_filter(filename, compact=True),
+                cmdline.repeat),
+        }
+
+
+def bench_audio(cmdline):
+    """
+    Export every segment of a synthetic recording from memory and from a
+    memory mapped WAV file: as views, as WAV bytes, and into a file.
+    """
+    segment_ms = cmdline.segment * 1000
+    segments = [(start, start + segment_ms)
+        for start in range(0, cmdline.seconds * 1000, segment_ms)]
+
+    def run(audio_data, mode):
+        def function():
+            if mode == 'view':
+                return sum(len(audio_data.export(start, end))
+                    for start, end in segments)
+            if mode == 'wav':
+                return sum(len(audio_data.export_wav(start, end))
+                    for start, end in segments)
+            output = io.BytesIO()
+            for start, end in segments:
+                audio_data.export(start, end, output)
+            return output.tell()
+        return function
+
+    result = {'seconds': cmdline.seconds, 'segments': len(segments)}
+    with tempfile.TemporaryDirectory() as tmp:
+        wav_file = os.path.join(tmp, 'synthetic.wav')
+        write_synthetic_wav(wav_file, cmdline.seconds, cmdline.seed)
+        sources = (('memory', synthetic_pcm(cmdline.seconds, cmdline.seed)),
+            ('mmap', process.map_wav_file(wav_file)))
+        for source, data in sources:
+            audio_data = process.AudioData(data)
+            for mode in ('view', 'wav', 'file'):
+                result[f'{source}_{mode}'] = measure(run(audio_data, mode),
+                    cmdline.repeat)
+            del audio_data, data
+    return result
+
+
+def bench_dal_writes(cmdline):
+    """
+    Write the subtitles of videos into a fresh database one row and commit
+    at a time, and in bulk inside a transaction.
+    """
+    result = {'videos': cmdline.videos, 'subtitles': cmdline.subtitles}
+    for mode in ('row', 'bulk'):
+        with tempfile.TemporaryDirectory() as tmp:
+            database = dal.DataAccessLayer(os.path.join(tmp, 'db.sqlite3'),
+                concurrent=cmdline.concurrent)
+            start = time.perf_counter()
+            for i in range(cmdline.videos):
+                video_id = f'video-{i}'
+                rows = [(f'caption {j} of {video_id}', j * 1000, j * 1000 + 900)
+                    for j in range(cmdline.subtitles)]
+                database.add_video(video_id, 'channel')
+                if mode == 'row':
+                    database.set_video_length(video_id,
+                        cmdline.subtitles * 1000)
+                    for row in rows:
+                        database.add_subtitle(video_id, *row)
+                else:
+                    with database.transaction():
+                        database.set_video_length(video_id,
+                            cmdline.subtitles * 1000)
+                        database.add_subtitles_bulk(video_id, rows)
+            elapsed = time.perf_counter() - start
+            result[mode] = {
+                'seconds': elapsed,
+                'subtitles_per_second':
+                    cmdline.videos * cmdline.subtitles / elapsed,
+            }
+    return result
+
+
+# Stands in for ffmpeg in replayed crawls, the fixture audio is raw PCM.
+FAKE_FFMPEG = """#!{python}
+import shutil, sys, wave
+source = sys.argv[sys.argv.index('-i') + 1]
+with open(source, 'rb') as f:
+    if sys.argv[-1] == '-':
+        shutil.copyfileobj(f, sys.stdout.buffer)
+    else:
+        with wave.open(sys.argv[-1], 'wb') as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(16000)
+            w.writeframes(f.read())
+"""
+
+
+def write_replay_video(directory, video_id, channel_id, rng, cmdline):
+    base = os.path.join(directory, 'videos', video_id)
+    seconds = rng.randint(cmdline.seconds // 2, cmdline.seconds)
+    with open(base + '.info.json', 'w') as f:
+        json.dump({'id': video_id, 'title': f'Video {video_id}',
+            'channel_id': channel_id, 'duration': seconds}, f)
+    # Every third channel has no subtitles, for the crawler to prune
+    if int(channel_id[len('channel'):]) % 3 != 0:
+        # Captions are 3.9 seconds long on average
+        write_synthetic_vtt(base + '.en.vtt', seconds * 10 // 39,
+            cmdline.overlap, rng.random())
+    with open(base + '.m4a', 'wb') as f:
+        f.write(synthetic_pcm(1, rng.random()) * seconds)
+
+
+def write_replay_fixtures(directory, cmdline):
+    """
+    Write search result pages, channels, and videos with synthetic subtitles
+    and audio in the layout of backends.ReplayBackend, returning the search
+    queries.
+    """
+    rng = random.Random(cmdline.seed)
+    for name in ('search', 'channels', 'videos'):
+        os.makedirs(os.path.join(directory, name))
+    channels = {f'channel{i}': [] for i in range(cmdline.channels)}
+    queries = [f'query {i}' for i in range(cmdline.queries)]
+    for query in queries:
+        pages = []
+        for page in range(cmdline.pages):
+            video_ids = [f'{query.replace(" ", "")}p{page}v{i}'
+                for i in range(cmdline.videos)]
+            pages.append(video_ids)
+            for video_id in video_ids:
+                channel_id = rng.choice(sorted(channels))
+                channels[channel_id].append(video_id)
+                write_replay_video(directory, video_id, channel_id, rng,
+                    cmdline)
+        with open(os.path.join(directory, 'search',
+                urllib.parse.quote(query, safe='') + '.json'), 'w') as f:
+            json.dump(pages, f)
+    for channel_id, video_ids in channels.items():
+        for i in range(cmdline.channel_videos):
+            video_id = f'{channel_id}v{i}'
+            video_ids.append(video_id)
+            write_replay_video(directory, video_id, channel_id, rng, cmdline)
+        with open(os.path.join(directory, 'channels', channel_id + '.json'),
+                'w') as f:
+            json.dump(video_ids, f)
+    return queries
+
+
+def bench_crawl(cmdline):
+    """
+    Crawl synthetic fixtures end to end with the replay backend, from the
+    search queries to the subtitles in the database, and report the
+    throughput in videos and hours of speech per hour.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        fixtures = os.path.join(tmp, 'fixtures')
+        queries = write_replay_fixtures(fixtures, cmdline)
+        query_file = os.path.join(tmp, 'queries.txt')
+        with open(query_file, 'w') as f:
+            f.write(''.join(query + '\n' for query in queries))
+        ffmpeg = os.path.join(tmp, 'ffmpeg')
+        with open(ffmpeg, 'w') as f:
+            f.write(FAKE_FFMPEG.format(python=sys.executable))
+        os.chmod(ffmpeg, 0o755)
+
+        dest = os.path.join(tmp, 'dest')
+        args = [sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                'crawler.py'),
+            '--dest', dest, '--query-file', query_file, '--ffmpeg', ffmpeg,
+            '--backend', 'replay', '--replay-dir', fixtures,
+            '--replay-latency', str(cmdline.latency),
+            '--download-workers', str(cmdline.download_workers),
+            '--process-workers', str(cmdline.process_workers),
+            '--stream-decode', '--db-concurrent']
+        if cmdline.bandwidth is not None:
+            args += ['--replay-bandwidth', str(cmdline.bandwidth)]
+        if cmdline.prescreen:
+            args.append('--prescreen')
+        start = time.perf_counter()
+        nodes = [subprocess.Popen(args, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            for i in range(cmdline.nodes)]
+        for node in nodes:
+            if node.wait() != 0:
+                raise RuntimeError(f'Crawler exited with {node.returncode}')
+        elapsed = time.perf_counter() - start
+
+        connection = sqlite3.connect(os.path.join(dest, 'db.sqlite3'))
+        videos, = connection.execute(
+            'SELECT COUNT(*) FROM video WHERE length IS NOT NULL').fetchone()
+        speech_ms, = connection.execute(
+            'SELECT COALESCE(SUM(end_time - start_time), 0) FROM subtitle'
+            ).fetchone()
+        jobs, attempts = connection.execute(
+            'SELECT COUNT(*), SUM(attempts) FROM job').fetchone()
+        channels = dict(connection.execute(
+            'SELECT status, COUNT(*) FROM channel GROUP BY status'))
+        connection.close()
+
+    hours = elapsed / 3600
+    return {
+        'queries': cmdline.queries,
+        'nodes': cmdline.nodes,
+        'jobs': jobs,
+        'job_attempts': attempts,
+        'fixture_videos': cmdline.queries * cmdline.pages * cmdline.videos
+            + cmdline.channels * cmdline.channel_videos,
+        'channels_done': channels.get(dal.DataAccessLayer.STATUS_DONE, 0),
+        'channels_pruned': channels.get(dal.DataAccessLayer.STATUS_PRUNED, 0),
+        'latency': cmdline.latency,
+        'bandwidth': cmdline.bandwidth,
+        'seconds': elapsed,
+        'videos': videos,
+        'speech_hours': speech_ms / 3600000,
+        'videos_per_hour': videos / hours,
+        'speech_hours_per_hour': speech_ms / 3600000 / hours,
+    }
+
+
+# Benchmarks run by the 'suite' command, with their default options.
+SUITE = ('parser', 'filter', 'subtitles', 'pipeline', 'overlap',
+    'normalizer', 'audio', 'dal-writes', 'align', 'crawl')
+
+
+def bench_suite(cmdline):
+    """
+    Run every benchmark in SUITE with its default, seeded options, so that
+    results can be compared across versions.
+    """
+    results = {}
+    for name in SUITE:
+        options = parse_cmdline([name])
+        start = time.perf_counter()
+        results[name] = options.run(options)
+        results[name]['wall_seconds'] = time.perf_counter() - start
+    return {'results': results}
+
+
+def add_synthetic_vtt_options(s):
+    s.add_argument('--captions', type=int, default=20000,
+        help='Number of captions in the synthetic VTT file.')
+    s.add_argument('--overlap', type=float, default=0.1,
+        help='Fraction of synthetic captions overlapping the one before.')
+    s.add_argument('--seed', type=int, default=0)
+
+
+def parse_cmdline(args=None):
+    p = argparse.ArgumentParser()
+    p.add_argument('--output',
+        help='Also write the JSON result to this file.')
+    sub = p.add_subparsers(dest='benchmark')
+    sub.required = True
+
+    s = sub.add_parser('suite', help='Run all of: ' + ', '.join(SUITE))
+    s.set_defaults(run=bench_suite)
+
+    s = sub.add_parser('dal-stress',
+        help='Concurrent writer processes against one database.')
+    s.add_argument('--writers', type=int, default=8)
+    s.add_argument('--videos', type=int, default=50,
+        help='Videos written by each writer.')
+    s.add_argument('--subtitles', type=int, default=200,
+        help='Subtitles per video.')
+    s.add_argument('--concurrent', action='store_true',
+        help='Use the WAL concurrency mode.')
+    s.add_argument('--mmap-size', type=int)
+    s.set_defaults(run=bench_dal_stress)
+
+    s = sub.add_parser('align',
+        help='Per caption versus windowed forced alignment.')
+    s.add_argument('--captions', type=int, default=500)
+    s.add_argument('--window', type=float, default=300,
+        help='Alignment window in seconds.')
+    s.add_argument('--latency', type=float, default=0.01,
+        help='Fake aligner latency per request in seconds.')
+    s.add_argument('--concurrency', type=int, default=4)
+    s.set_defaults(run=bench_align)
+
+    s = sub.add_parser('crawl',
+        help='End to end crawl of synthetic fixtures with the replay backend.')
+    s.add_argument('--queries', type=int, default=2)
+    s.add_argument('--pages', type=int, default=2,
+        help='Search result pages per query.')
+    s.add_argument('--videos', type=int, default=5,
+        help='Videos per search result page.')
+    s.add_argument('--channels', type=int, default=6,
+        help='Number of channels, every third one without subtitles.')
+    s.add_argument('--channel-videos', type=int, default=5,
+        help='Videos of every channel found only by crawling the channel.')
+    s.add_argument('--seconds', type=int, default=120,
+        help='Maximum length of a video.')
+    s.add_argument('--overlap', type=float, default=0.1,
+        help='Fraction of captions overlapping the one before.')
+    s.add_argument('--latency', type=float, default=0.05,
+        help='Seconds every replayed request takes.')
+    s.add_argument('--bandwidth', type=float,
+        help='Bytes per second of the simulated link, unlimited by default.')
+    s.add_argument('--nodes', type=int, default=1,
+        help='Number of crawlers sharing the database.')
+    s.add_argument('--download-workers', type=int, default=4)
+    s.add_argument('--process-workers', type=int, default=2)
+    s.add_argument('--prescreen', action='store_true')
+    s.add_argument('--seed', type=int, default=0)
+    s.set_defaults(run=bench_crawl)
+
+    s = sub.add_parser('dal-writes',
+        help='Per row versus bulk subtitle writes in one process.')
+    s.add_argument('--videos', type=int, default=200)
+    s.add_argument('--subtitles', type=int, default=200,
+        help='Subtitles per video.')
+    s.add_argument('--concurrent', action='store_true',
+        help='Use the WAL concurrency mode.')
+    s.set_defaults(run=bench_dal_writes)
+
+    s = sub.add_parser('filter',
+        help='load_all_subtitles() versus load_and_filter().')
+    s.add_argument('--file', help='VTT file, a synthetic one by default.')
+    add_synthetic_vtt_options(s)
+    s.add_argument('--repeat', type=int, default=3)
+    s.set_defaults(run=bench_filter)
+
+    s = sub.add_parser('audio',
+        help='Export segments of a synthetic recording with AudioData.')
+    s.add_argument('--seconds', type=int, default=600,
+        help='Length of the synthetic recording.')
+    s.add_argument('--segment', type=int, default=5,
+        help='Length of the exported segments in seconds.')
+    s.add_argument('--seed', type=int, default=0)
+    s.add_argument('--repeat', type=int, default=3)
+    s.set_defaults(run=bench_audio)
+
+    s = sub.add_parser('subtitles',
+        help='Dict versus compact Caption subtitle representation.')
+    s.add_argument('--file', help='VTT file, a synthetic one by default.')
+    add_synthetic_vtt_options(s)
+    s.add_argument('--repeat', type=int, default=3)
+    s.set_defaults(run=bench_subtitles)
+
+    s = sub.add_parser('pipeline',
+        help='Filter pipeline modes: per filter, batch and stream.')
+    s.add_argument('--file', help='VTT file, a synthetic one by default.')
+    add_synthetic_vtt_options(s)
+    s.add_argument('--repeat', type=int, default=3)
+    s.set_defaults(run=bench_pipeline)
+
+    s = sub.add_parser('parser',
+        help='Check and time the VTT parser against webvtt-py.')
+    s.add_argument('files', nargs='*',
+        help='VTT files, testdata/vtt and a synthetic one by default.')
+    add_synthetic_vtt_options(s)
+    s.set_defaults(run=bench_parser)
+
+    s = sub.add_parser('overlap',
+        help='Check and time overlap removal and merging of captions.')
+    s.add_argument('--cases', type=int, default=2000,
+        help='Number of random caption sequences to check.')
+    add_synthetic_vtt_options(s)
+    s.set_defaults(run=bench_overlap)
+
+    s = sub.add_parser('normalizer',
+        help='Check and time the compiled text normalizer.')
+    s.add_argument('files', nargs='*',
+        help='VTT files, a synthetic one by default.')
+    add_synthetic_vtt_options(s)
+    s.add_argument('--fuzz', type=int, default=20000,
+        help='Number of random strings added to the corpus.')
+    s.add_argument('--repeat', type=int, default=3)
+    s.set_defaults(run=bench_normalizer)
+
+    return p.parse_args(args)
+
+
+def count_mismatches(result):
+    """
+    Number of mismatches found by a checking benchmark, or by all the ones
+    run by the suite.
+    """
+    count = len(result.get('mismatches', ())) \
+        + len(result.get('mismatched_files', ()))
+    for value in result.get('results', {}).values():
+        count += count_mismatches(value)
+    return count
+
+
+def main():
+    cmdline = parse_cmdline()
+    result = cmdline.run(cmdline)
+    result['benchmark'] = cmdline.benchmark
+    result['environment'] = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+    output = json.dumps(result, indent=2)
+    print(output)
+    if cmdline.output:
+        with open(cmdline.output, 'w') as f:
+            f.write(output + '\n')
+    if count_mismatches(result) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
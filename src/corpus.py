@@ -0,0 +1,81 @@
+import json
+import os
+import socket
+import tarfile
+import time
+
+
+class ShardWriter:
+    """
+    Write utterance clips into a sequence of tar shards in the WebDataset
+    layout: each clip is stored as <key>.wav, <key>.txt and <key>.json
+    members next to each other, so readers can stream shards sequentially.
+
+    A shard is written as <name>.tar.partial and renamed to <name>.tar once
+    it is complete. Shard names include the host name and process id, so
+    many workers can write into the same directory.
+    """
+    def __init__(self, directory, max_size=1024 * 1024 * 1024):
+        os.makedirs(directory, exist_ok=True)
+        self.__directory = directory
+        self.__max_size = max_size
+        self.__prefix = f'{socket.gethostname()}-{os.getpid()}'
+        self.__index = 0
+        self.__file = None
+        self.__path = None
+
+    def add(self, key, wav_header, samples, transcript, metadata=None):
+        if self.__file is None:
+            self.__open()
+        self.__add_member(f'{key}.wav', wav_header, samples)
+        self.__add_member(f'{key}.txt', transcript.encode('utf-8'))
+        if metadata is not None:
+            self.__add_member(f'{key}.json',
+                json.dumps(metadata, sort_keys=True).encode('utf-8'))
+        if self.__file.tell() >= self.__max_size:
+            self.close()
+
+    def close(self):
+        if self.__file is None:
+            return
+        self.__file.write(tarfile.NUL * 2 * tarfile.BLOCKSIZE)
+        remainder = self.__file.tell() % tarfile.RECORDSIZE
+        if remainder:
+            self.__file.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+        self.__file.close()
+        os.rename(self.__path, self.__path[:-len('.partial')])
+        self.__file = None
+
+    def __open(self):
+        self.__index += 1
+        name = f'{self.__prefix}-{int(time.time())}-{self.__index:06d}.tar'
+        self.__path = os.path.join(self.__directory, name + '.partial')
+        self.__file = open(self.__path, 'wb')
+
+    def __add_member(self, name, *chunks):
+        info = tarfile.TarInfo(name)
+        info.size = sum(len(c) for c in chunks)
+        info.mtime = int(time.time())
+        self.__file.write(info.tobuf(tarfile.GNU_FORMAT))
+        for chunk in chunks:
+            self.__file.write(chunk)
+        remainder = info.size % tarfile.BLOCKSIZE
+        if remainder:
+            self.__file.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+
+def read_shard(path):
+    """
+    Yield (key, {extension: bytes}) for each clip in a shard.
+    """
+    with tarfile.open(path, 'r') as tar:
+        key, sample = None, {}
+        for member in tar:
+            base, _, extension = member.name.rpartition('.')
+            if base != key and sample:
+                yield key, sample
+                sample = {}
+            key = base
+            sample[extension] = tar.extractfile(member).read()
+        if sample:
+            yield key, sample
@@ -3,76 +3,285 @@
 import argparse
 import urllib.parse
 import os.path
+import shlex
+import socket
+import sqlite3
 import sys
 import logging
+import functools
+import threading
+import time
 
-import youtube_dl
+from youtube_dl.postprocessor.common import PostProcessor
 
+import backends
 import dal
+import metrics
+import process
+import scheduler
+import worker
+from prescreen import SubtitlePreScreen
+
+DEFAULT_NODE_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+# Options of process.add_processing_options() forwarded to process.py
+PROCESSING_VALUES = ('dest', 'lang', 'ffmpeg', 'alignment_service',
+    'align_window', 'aligner_concurrency', 'aligner_timeout',
+    'aligner_retries', 'aligner_version', 'align_cache_size', 'shard_size',
+    'mmap_threshold', 'db_mmap_size')
+PROCESSING_FLAGS = ('forced_align', 'fix_data', 'stream_decode',
+    'export_clips', 'db_concurrent')
 
 
 class ProgressManager:
+    """
+    Hand out search result pages, channel listings and videos as jobs leased
+    from the database, so that any number of crawlers can share it. Jobs
+    are claimed `batch_size` at a time, and kept leased by a LeaseHeartbeat
+    while they are downloaded. A job whose download fails is released to
+    be claimed again, up to MAX_ATTEMPTS times.
+
+    Channels form a frontier ordered by subtitle yield: the uploads of a
+    channel are listed once, up to MAX_CHANNEL_SIZE videos, and each video
+    not seen yet becomes a video job with the yield of its channel as
+    priority, so the videos of the channels with the most usable subtitles
+    per video are downloaded first. Channels yielding less than
+    `min_channel_yield` after `min_channel_checked` videos are pruned, along
+    with their video jobs left.
+    """
     NUM_SEARCH_RESULTS = 30
     MAX_CHANNEL_SIZE = 100
+    MAX_ATTEMPTS = 3
 
-    def __init__(self, database: dal.DataAccessLayer):
+    def __init__(self, database: dal.DataAccessLayer, owner,
+            lease_seconds=300, batch_size=1, min_channel_checked=3,
+            min_channel_yield=0.1):
         self.__database = database
+        self.__owner = owner
+        self.__lease_seconds = lease_seconds
+        self.__batch_size = batch_size
+        self.__min_channel_checked = min_channel_checked
+        self.__min_channel_yield = min_channel_yield
+        self.claimed = 0
+
+    def queue_jobs(self):
+        """
+        Add jobs for the searches, channels and videos not queued yet. The
+        progress of searches and channels crawled before jobs existed is
+        kept.
+        """
+        for query, wip in self.__database.fetch_new_queries():
+            start = 0 if wip is None else int(wip)
+            self.__database.queue_jobs('search', query,
+                range(start + 1, self.NUM_SEARCH_RESULTS + 1))
+        self.__prune_channels()
+        for channel_id, speech_yield in self.__database.fetch_good_channels():
+            self.__database.queue_jobs('channel', channel_id, [0],
+                speech_yield)
+        for video_id, _ in self.__database.fetch_new_videos():
+            self.__database.queue_jobs('video', video_id, [0])
 
     def fetch_search_job(self):
-        for query, wip in self.__database.fetch_new_queries():
-            if wip is None:
-                start = 0
-            else:
-                start = int(wip)
-            for page in range(start + 1, self.NUM_SEARCH_RESULTS + 1):
-                yield query, page
+        return self.__claim('search')
 
     def mark_search_job(self, job):
-        self.__database.set_query_wip(job[0], job[1])
-        if job[1] >= self.NUM_SEARCH_RESULTS:
-            self.__database.set_query_done(job[0])
+        self.__complete('search', job)
+
+    def fail_search_job(self, job):
+        self.__fail('search', job)
 
     def fetch_channel_job(self):
-        for channel_id, wip, size in self.__database.fetch_good_channels():
-            if wip is None:
-                start = 0
-            else:
-                start = int(wip)
-            for item in range(start + 1, size + 1):
-                yield channel_id, item
-
-    def mark_channel_job(self, job):
-        self.__database.set_channel_wip(job[0], job[1])
-        if job[1] >= self.MAX_CHANNEL_SIZE:
-            self.__database.set_channel_done(job[0])
+        return self.__claim('channel')
+
+    def mark_channel_job(self, job, info):
+        """
+        Queue the videos of the uploads listing `info` of a channel job, and
+        complete the job.
+        """
+        if info is None:
+            self.fail_channel_job(job)
+            return
+        channel_id, _ = job
+        video_ids = [entry['id'] for entry in info.get('entries') or []
+            if entry and entry.get('id')]
+        self.__database.queue_channel_videos(channel_id, video_ids)
+        self.__complete('channel', job)
+
+    def fail_channel_job(self, job):
+        self.__fail('channel', job)
 
     def fetch_video_job(self):
-        return self.__database.fetch_new_videos()
+        return self.__claim('video')
 
     def mark_video_job(self, job):
-        self.__database.set_video_status(job[0],
-            dal.DataAccessLayer.STATUS_DONE)
+        self.__complete('video', job)
+
+    def fail_video_job(self, job):
+        self.__fail('video', job)
 
     def has_job(self):
-        return len(self.__database.fetch_new_queries()) != 0 \
-            or len(self.__database.fetch_good_channels()) != 0
+        return self.__database.has_pending_work()
+
+    def __claim(self, kind):
+        while True:
+            if kind == 'channel':
+                self.__prune_channels()
+            jobs = self.__database.claim_jobs(kind, self.__owner,
+                self.__lease_seconds, self.__batch_size)
+            if not jobs:
+                return
+            self.claimed += len(jobs)
+            yield from jobs
+
+    def __prune_channels(self):
+        pruned = self.__database.prune_channels(self.__min_channel_checked,
+            self.__min_channel_yield)
+        if pruned:
+            logging.info('Pruned %d low yield channels', pruned)
+
+    def __complete(self, kind, job):
+        if not self.__database.complete_job(kind, *job, self.__owner):
+            logging.warning('Lease of %s job %s expired before it finished',
+                kind, job)
+
+    def __fail(self, kind, job):
+        if not self.__database.fail_job(kind, *job, self.__owner,
+                self.MAX_ATTEMPTS):
+            logging.warning('Lease of %s job %s expired before it failed',
+                kind, job)
+
+
+class LeaseHeartbeat:
+    """
+    Renew the leases of `owner` every third of `lease_seconds`, from a
+    thread with its own connection to the database opened by
+    `open_database`, so that long downloads don't lose their jobs.
+    """
+    def __init__(self, open_database, owner, lease_seconds):
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run,
+            args=(open_database, owner, lease_seconds), daemon=True)
+        self.__thread.start()
+
+    def close(self):
+        self.__stop.set()
+        self.__thread.join()
+
+    def __run(self, open_database, owner, lease_seconds):
+        database = open_database()
+        while not self.__stop.wait(lease_seconds / 3):
+            try:
+                database.renew_leases(owner, lease_seconds)
+            except sqlite3.Error:
+                logging.exception('Cannot renew the leases of %s', owner)
+
+
+class HandoffPostProcessor(PostProcessor):
+    """
+    Hand off a downloaded file to a processing stage (the worker daemon or
+    a local process pool) instead of starting a new process.py for it.
+    """
+    def __init__(self, handoff, downloader=None):
+        super().__init__(downloader)
+        self.__handoff = handoff
+
+    def run(self, information):
+        self.__handoff(information['filepath'])
+        return [], information
 
 
 def parse_cmdline():
     p = argparse.ArgumentParser()
-    p.add_argument('--dest', required=True, help='Directory to save stuff')
-    p.add_argument('--lang', default='en', choices=('en', 'zh-CN'),
-        help='Subtitle language.')
-    p.add_argument('--ffmpeg', default='ffmpeg', help='ffmpeg path.')
+    process.add_processing_options(p, default_lang='en')
     p.add_argument('--test-url',
         help='Download a given URL, for debugging purposes.')
     p.add_argument('--query-file',
         help='A file containing initial search queries.')
     p.add_argument('--dry-run', action='store_true',
         help='Don\'t download the actual audio file, for debugging purposes.')
-    p.add_argument('--forced-align', action='store_true',
-        help='Run "forced alignment" post processing step.')
-    return p.parse_args()
+    p.add_argument('--worker-socket',
+        help='Hand off downloaded files to the worker daemon listening on '
+            'this Unix socket, instead of running process.py for each file.')
+    p.add_argument('--process-workers', type=int, default=0,
+        help='Process downloaded files in a pool of this many worker '
+            'processes, overlapping downloading and processing.')
+    p.add_argument('--max-pending', type=int,
+        help='Maximum number of downloaded files waiting for the process '
+            'pool before downloading blocks, defaults to twice the number '
+            'of workers.')
+    p.add_argument('--download-workers', type=int, default=1,
+        help='Number of search pages and videos to download concurrently.')
+    p.add_argument('--host-interval', type=float, default=0,
+        help='Minimum number of seconds between two downloads from the '
+            'same host.')
+    p.add_argument('--prescreen', action='store_true',
+        help='Filter the subtitles of every video before downloading its '
+            'audio, skipping the videos without usable subtitles.')
+    p.add_argument('--min-speech-seconds', type=float, default=0,
+        help='With --prescreen, minimum total duration of the subtitles '
+            'passing the filters for the audio to be downloaded.')
+    metrics.add_metrics_options(p)
+    p.add_argument('--node-id', default=DEFAULT_NODE_ID,
+        help='Name of this crawler in the job leases of the database, '
+            'defaults to HOST:PID. Crawlers sharing a database must all run '
+            'on the host storing it.')
+    p.add_argument('--lease-seconds', type=float, default=300,
+        help='Seconds a crawler keeps its jobs without renewing the lease '
+            'before other crawlers may take them over.')
+    p.add_argument('--min-channel-checked', type=int, default=3,
+        help='Number of videos of a channel to check before it may be '
+            'pruned.')
+    p.add_argument('--min-channel-yield', type=float, default=0.1,
+        help='Prune channels with fewer seconds of usable subtitles per '
+            'second of video.')
+    backends.add_backend_options(p)
+    cmdline = p.parse_args()
+    if cmdline.backend == 'replay' and cmdline.replay_dir is None:
+        p.error('--backend replay requires --replay-dir')
+    if cmdline.export_clips and cmdline.process_workers == 0:
+        # A process.py run per video would write a shard per video.
+        p.error('--export-clips requires --process-workers; with '
+            '--worker-socket, pass it to the worker daemon')
+    return cmdline
+
+
+def processing_args(cmdline):
+    """
+    Turn the options added by process.add_processing_options() back into
+    arguments for process.py.
+    """
+    r = []
+    for name in PROCESSING_VALUES:
+        value = getattr(cmdline, name)
+        if value is not None:
+            r += ['--' + name.replace('_', '-'), str(value)]
+    for name in PROCESSING_FLAGS:
+        if getattr(cmdline, name):
+            r.append('--' + name.replace('_', '-'))
+    return r
+
+
+def start_processing_stage(cmdline):
+    if cmdline.worker_socket:
+        return None, functools.partial(worker.send_video,
+            cmdline.worker_socket)
+    if cmdline.process_workers > 0:
+        stage = worker.ProcessingStage(
+            process.parse_processing_options(processing_args(cmdline)),
+            cmdline.process_workers,
+            cmdline.max_pending or 2 * cmdline.process_workers)
+        return stage, stage.submit
+    return None, None
+
+
+def start_prescreen(cmdline, options, backend):
+    if not cmdline.prescreen:
+        return None
+    prescreen = SubtitlePreScreen(cmdline.lang, cmdline.min_speech_seconds,
+        options['download_archive'], options['socket_timeout'],
+        backend.urlopen)
+    options['match_filter'] = prescreen
+    return prescreen
 
 
 def build_youtube_options(cmdline):
@@ -98,15 +307,17 @@ def build_youtube_options(cmdline):
         'skip_download': cmdline.dry_run,
     }
 
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    audio = '{}'
-    exec_cmd = f'{sys.executable} {script_dir}/process.py {audio} --dest {cmdline.dest} --lang {cmdline.lang}'
-    if cmdline.forced_align:
-        exec_cmd += ' --forced-align'
     r['postprocessors'] = [
         {'key': 'FFmpegSubtitlesConvertor', 'format': 'vtt'},
-        {'key': 'ExecAfterDownload', 'exec_cmd': exec_cmd}
     ]
+    if not cmdline.worker_socket and cmdline.process_workers == 0:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        # youtube_dl replaces {} with the quoted file path.
+        exec_cmd = ' '.join(shlex.quote(arg) for arg in [sys.executable,
+            f'{script_dir}/process.py']) + ' {} ' + ' '.join(
+            shlex.quote(arg) for arg in processing_args(cmdline))
+        r['postprocessors'].append(
+            {'key': 'ExecAfterDownload', 'exec_cmd': exec_cmd})
 
     if cmdline.ffmpeg != 'ffmpeg':
         r['ffmpeg_location'] = cmdline.ffmpeg
@@ -114,51 +325,121 @@ def build_youtube_options(cmdline):
     return r
 
 
-def test_download(url, options):
-    with youtube_dl.YoutubeDL(options) as yt:
+def open_youtube(backend, options, handoff):
+    youtube = backend.open(options)
+    if handoff is not None:
+        youtube.add_post_processor(HandoffPostProcessor(handoff))
+    return youtube
+
+
+def test_download(url, backend, options, handoff):
+    with open_youtube(backend, options, handoff) as yt:
         yt.download([url])
 
 
-def download_forever(database, cmdline, youtube_options):
-    manager = ProgressManager(database)
+def search_downloads(manager: ProgressManager):
+    for query, page in manager.fetch_search_job():
+        logging.info("Downloading search result page: %s, %d", query, page)
+        quoted = urllib.parse.quote(query)
+        url = f'https://www.youtube.com/results?sp=EgQIBCgB&q={quoted}&p={page}'
+        yield (query, page), url
 
-    while manager.has_job():
-        for query, page in manager.fetch_search_job():
-            logging.info("Downloading search result page: %s, %d", query, page)
-            quoted = urllib.parse.quote(query)
-            url = f'https://www.youtube.com/results?sp=EgQIBCgB&q={quoted}&p={page}'
-            with youtube_dl.YoutubeDL(youtube_options) as youtube:
-                youtube.download([url])
-            manager.mark_search_job((query, page))
 
-        # TODO implement channel crawling functionality.
-        """
-        for job in manager.fetch_channel_job():
-            pass
-        """
+def channel_listings(manager: ProgressManager):
+    for channel_id, item in manager.fetch_channel_job():
+        logging.info("Listing channel uploads: %s", channel_id)
+        url = f'https://www.youtube.com/channel/{channel_id}/videos'
+        yield (channel_id, item), url, {'extract_flat': 'in_playlist',
+            'playlistend': manager.MAX_CHANNEL_SIZE}
+
+
+def video_downloads(manager: ProgressManager):
+    for video_id, item in manager.fetch_video_job():
+        url = f'https://www.youtube.com/watch?v={video_id}'
+        yield (video_id, item), url
+
+
+def download_forever(database, manager: ProgressManager,
+        downloads: scheduler.DownloadScheduler,
+        prescreen: SubtitlePreScreen = None,
+        stage: worker.ProcessingStage = None, poll_interval=5):
+    def has_job():
+        if manager.has_job():
+            return True
+        if stage is None:
+            return False
+        # Videos still being processed may add new channels to crawl.
+        stage.wait()
+        return manager.has_job()
 
-        for video_id, channel_id in manager.fetch_video_job():
-            url = f'https://www.youtube.com/watch?v={video_id}'
-            with youtube_dl.YoutubeDL(youtube_options) as youtube:
-                youtube.download([url])
-            manager.mark_video_job((video_id, channel_id))
+    def record_prescreen(mark_job):
+        if prescreen is None:
+            return mark_job
+
+        def mark(job):
+            mark_job(job)
+            prescreen.record(database)
+        return mark
+
+    while has_job():
+        manager.queue_jobs()
+        claimed = manager.claimed
+        downloads.run(search_downloads(manager),
+            record_prescreen(manager.mark_search_job),
+            manager.fail_search_job)
+
+        downloads.extract(channel_listings(manager),
+            manager.mark_channel_job, manager.fail_channel_job)
+
+        downloads.run(video_downloads(manager),
+            record_prescreen(manager.mark_video_job),
+            manager.fail_video_job)
+
+        if manager.claimed == claimed:
+            # The jobs left are leased by other crawlers, wait for them to
+            # finish or for their leases to expire.
+            time.sleep(poll_interval)
 
 
 def main():
     logging.basicConfig(level=logging.INFO)
     cmdline = parse_cmdline()
     options = build_youtube_options(cmdline)
-
-    if cmdline.test_url:
-        test_download(cmdline.test_url, options)
-        return
-
-    database = dal.DataAccessLayer(f'{cmdline.dest}/db.sqlite3')
-    if cmdline.query_file:
-        with open(cmdline.query_file) as f:
-            for line in f:
-                database.add_search_query(line.strip())
-    download_forever(database, cmdline, options)
+    backend = backends.open_backend(cmdline)
+    prescreen = start_prescreen(cmdline, options, backend)
+
+    stage, handoff = start_processing_stage(cmdline)
+    exporter = metrics.start_exporter(cmdline)
+    try:
+        if cmdline.test_url:
+            test_download(cmdline.test_url, backend, options, handoff)
+            return
+
+        database = process.open_database(cmdline)
+        if cmdline.query_file:
+            with open(cmdline.query_file) as f:
+                for line in f:
+                    database.add_search_query(line.strip())
+        downloads = scheduler.DownloadScheduler(cmdline.download_workers,
+            scheduler.InstancePool(
+                functools.partial(open_youtube, backend, options, handoff)),
+            scheduler.RateLimiter(cmdline.host_interval))
+        manager = ProgressManager(database, cmdline.node_id,
+            cmdline.lease_seconds, cmdline.download_workers,
+            cmdline.min_channel_checked, cmdline.min_channel_yield)
+        heartbeat = LeaseHeartbeat(
+            functools.partial(process.open_database, cmdline),
+            cmdline.node_id, cmdline.lease_seconds)
+        try:
+            download_forever(database, manager, downloads, prescreen, stage)
+        finally:
+            downloads.close()
+            heartbeat.close()
+            database.release_jobs(cmdline.node_id)
+    finally:
+        if stage is not None:
+            stage.close()
+        exporter.close()
 
 
 if __name__ == '__main__':
@@ -1,28 +1,208 @@
 import sqlite3
+import contextlib
+import logging
 import os.path
+import time
+
+# File systems on which SQLite locking can't be relied on
+NETWORK_FILESYSTEMS = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', '9p',
+    'fuse.sshfs', 'glusterfs', 'ceph', 'lustre'}
+
+
+def get_filesystem_type(path):
+    """
+    Return the type of the file system `path` is on, according to
+    /proc/self/mounts, or None where that isn't available.
+    """
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    try:
+        with open('/proc/self/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                prefix = mount_point.rstrip('/') + '/'
+                if (path == mount_point or path.startswith(prefix)) \
+                        and len(mount_point) >= len(best):
+                    best, fstype = mount_point, fields[2]
+    except OSError:
+        return None
+    return fstype
+
+
+# Schema migrations, MIGRATIONS[n - 1] upgrades a database from version n - 1
+# to version n. Databases created before versioning was introduced already
+# have the version 1 tables, hence "IF NOT EXISTS".
+MIGRATIONS = [
+    [
+        """CREATE TABLE IF NOT EXISTS search (
+            query VARCHAR(255) PRIMARY KEY,
+            status INT NOT NULL,
+            wip TEXT,
+            create_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            update_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )""",
+        """CREATE TABLE IF NOT EXISTS channel (
+            channel_id VARCHAR(255) PRIMARY KEY,
+            status INT NOT NULL,
+            wip TEXT,
+            size INT,
+            num_checked INT NOT NULL DEFAULT 0,
+            num_valid INT NOT NULL DEFAULT 0,
+            create_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            update_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )""",
+        """CREATE TABLE IF NOT EXISTS video (
+            video_id VARCHAR(255) PRIMARY KEY,
+            status INT NOT NULL,
+            channel_id VARCHAR(255),
+            file VARCHAR(255),
+            length INT,
+            publish_time DATETIME,
+            create_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            update_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )""",
+        """CREATE TABLE IF NOT EXISTS subtitle (
+            subtitle_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            video_id VARCHAR(255) NOT NULL,
+            aligned INT NOT NULL,
+            start_time INT NOT NULL,
+            end_time INT NOT NULL,
+            content TEXT NOT NULL,
+            create_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            update_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+            FOREIGN KEY (video_id) REFERENCES video(video_id)
+                ON DELETE CASCADE ON UPDATE CASCADE
+        )""",
+    ],
+    [
+        'CREATE INDEX search_status ON search (status, query)',
+        'CREATE INDEX channel_status ON channel (status, create_time)',
+        'CREATE INDEX video_status ON video (status, create_time)',
+        'CREATE INDEX subtitle_video ON subtitle (video_id)',
+    ],
+    [
+        # Search result pages, channel items and videos to download, leased
+        # by one crawler at a time. Leases rely on SQLite locking, so the
+        # crawlers sharing a database must all run on the host storing it.
+        """CREATE TABLE job (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind VARCHAR(16) NOT NULL,
+            key VARCHAR(255) NOT NULL,
+            item INT NOT NULL,
+            status INT NOT NULL,
+            owner VARCHAR(255),
+            lease_expire REAL,
+            attempts INT NOT NULL DEFAULT 0,
+            create_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            update_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+            UNIQUE (kind, key, item)
+        )""",
+        'CREATE INDEX job_status ON job (status, kind, job_id)',
+        'CREATE INDEX job_owner ON job (owner)',
+    ],
+    [
+        # Subtitle yield of channels: milliseconds of usable subtitles per
+        # millisecond of video checked. Jobs are claimed by priority, the
+        # yield for channel items.
+        'ALTER TABLE channel ADD COLUMN checked_ms INT NOT NULL DEFAULT 0',
+        'ALTER TABLE channel ADD COLUMN speech_ms INT NOT NULL DEFAULT 0',
+        'ALTER TABLE channel ADD COLUMN speech_yield REAL NOT NULL DEFAULT 0',
+        'CREATE INDEX channel_yield ON channel (status, speech_yield)',
+        'ALTER TABLE job ADD COLUMN priority REAL NOT NULL DEFAULT 0',
+        'DROP INDEX job_status',
+        'CREATE INDEX job_status ON job (status, kind, priority DESC, job_id)',
+    ],
+    [
+        # A channel is listed by a single job, which queues a video job for
+        # each of its videos, prioritized by the channel's yield, instead of
+        # one job per channel item. Channels with item jobs left (status 2,
+        # STATUS_NEW) go back from STATUS_QUEUED (4) to be listed again.
+        'ALTER TABLE job ADD COLUMN channel_id VARCHAR(255)',
+        'CREATE INDEX job_channel ON job (channel_id, status)',
+        "UPDATE channel SET status = 2 WHERE status = 4 AND channel_id IN (SELECT key FROM job WHERE kind = 'channel' AND status = 2)",
+        "DELETE FROM job WHERE kind = 'channel' AND status = 2",
+    ],
+]
 
 
 class DataAccessLayer:
     STATUS_UNKNOWN_ERROR = 1
     STATUS_NEW = 2
     STATUS_SOURCE_ERROR = 3
+    STATUS_QUEUED = 4
     STATUS_DONE = 5
 
     STATUS_DOWNLOADED = 6
     STATUS_SUBS_MISSING = 7
     STATUS_INVALID_SUBS = 8
+    STATUS_PRUNED = 9
+
+    BUSY_TIMEOUT = 60
 
-    def __init__(self, dbfile):
-        if not os.path.isfile(dbfile) and not os.path.islink(dbfile):
-            self.__connection = self.__create_db(dbfile)
-        else:
-            self.__connection = sqlite3.connect(dbfile)
+    # Table and key column of the searches, channels and videos behind
+    # each kind of job
+    JOB_KINDS = {
+        'search': ('search', 'query'),
+        'channel': ('channel', 'channel_id'),
+        'video': ('video', 'video_id'),
+    }
+
+    def __init__(self, dbfile, concurrent=False, mmap_size=None):
+        """
+        With `concurrent`, the database is switched to WAL journaling and
+        connections wait up to BUSY_TIMEOUT seconds for locks, so that many
+        processes on one host can write to it at the same time. Whatever
+        the journal mode, all processes using the database must run on the
+        host storing it. `mmap_size` sets the number of bytes of the
+        database file accessed through mmap.
+        """
+        self.__batch_depth = 0
+        fstype = get_filesystem_type(os.path.dirname(os.path.abspath(dbfile)))
+        if fstype in NETWORK_FILESYSTEMS:
+            logging.warning('Database %s is on a %s file system, SQLite '
+                'locking may not keep processes on other hosts from '
+                'corrupting it', dbfile, fstype)
+        self.__connection = sqlite3.connect(dbfile)
+        if concurrent:
+            self.__connection.execute(
+                f'PRAGMA busy_timeout = {self.BUSY_TIMEOUT * 1000}')
+            self.__connection.execute('PRAGMA journal_mode = WAL')
+            self.__connection.execute('PRAGMA synchronous = NORMAL')
+        if mmap_size is not None:
+            self.__connection.execute(f'PRAGMA mmap_size = {int(mmap_size)}')
+        self.__migrate()
+
+    @contextlib.contextmanager
+    def transaction(self, immediate=False):
+        """
+        Group all writes made inside the block into a single commit, or roll
+        them all back if the block raises. Transactions may be nested, only
+        the outermost one commits. With `immediate`, the outermost one takes
+        the write lock when the block starts instead of at its first write.
+        """
+        if immediate and self.__batch_depth == 0:
+            self.__connection.execute('BEGIN IMMEDIATE')
+        self.__batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.__batch_depth -= 1
+            if self.__batch_depth == 0:
+                self.__connection.rollback()
+            raise
+        self.__batch_depth -= 1
+        self.__commit()
 
     def add_search_query(self, query):
         self.__connection.execute(
-            "INSERT INTO search (query, status) VALUES (?, ?)",
+            "INSERT OR IGNORE INTO search (query, status) VALUES (?, ?)",
             (query, self.STATUS_NEW))
-        self.__connection.commit()
+        self.__commit()
 
     def fetch_new_queries(self):
         cursor = self.__connection.cursor()
@@ -35,127 +215,288 @@ class DataAccessLayer:
         cursor.execute('UPDATE search SET wip = ? WHERE query = ?',
             [wip, query])
         assert cursor.rowcount == 1
-        self.__connection.commit()
+        self.__commit()
 
     def set_query_done(self, query):
         cursor = self.__connection.cursor()
         cursor.execute('UPDATE search SET status = ? WHERE query = ?',
             [self.STATUS_DONE, query])
         assert cursor.rowcount == 1
-        self.__connection.commit()
+        self.__commit()
 
     def add_channel(self, channel_id, size):
         self.__connection.execute(
             'INSERT INTO channel (channel_id, size, status) VALUES (?, ?, ?)',
             [channel_id, size, self.STATUS_NEW])
-        self.__connection.commit()
+        self.__commit()
 
     def fetch_good_channels(self):
         cursor = self.__connection.cursor()
-        cursor.execute('SELECT channel_id, wip FROM channel WHERE status = ? ORDER BY create_time ASC',
+        cursor.execute('SELECT channel_id, speech_yield FROM channel WHERE status = ? ORDER BY speech_yield DESC, create_time ASC',
             [self.STATUS_NEW])
         return cursor.fetchall()
 
+    def queue_channel_videos(self, channel_id, video_ids):
+        """
+        Record the size of the uploads listing of a channel, and add a video
+        job for each of `video_ids` not in the database yet, prioritized by
+        the subtitle yield of the channel.
+        """
+        with self.__write_lock() as connection:
+            connection.execute('UPDATE channel SET size = ? WHERE channel_id = ?',
+                [len(video_ids), channel_id])
+            connection.executemany("INSERT OR IGNORE INTO job (kind, key, item, status, priority, channel_id) SELECT 'video', ?, 0, ?, speech_yield, channel_id FROM channel WHERE channel_id = ? AND NOT EXISTS (SELECT 1 FROM video WHERE video_id = ?)",
+                ((video_id, self.STATUS_NEW, channel_id, video_id)
+                    for video_id in video_ids))
+
+    def add_channel_sample(self, channel_id, checked_ms, speech_ms, valid):
+        """
+        Add a checked video to the subtitle yield of its channel, adding
+        the channel if it is new, and reprioritize the channel's jobs.
+        """
+        with self.transaction():
+            self.__connection.execute(
+                'INSERT OR IGNORE INTO channel (channel_id, status) VALUES (?, ?)',
+                [channel_id, self.STATUS_NEW])
+            self.__connection.execute('UPDATE channel SET num_checked = num_checked + 1, num_valid = num_valid + ?, checked_ms = checked_ms + ?, speech_ms = speech_ms + ?, speech_yield = CAST(speech_ms + ? AS REAL) / MAX(checked_ms + ?, 1), update_time = CURRENT_TIMESTAMP WHERE channel_id = ?',
+                [1 if valid else 0, checked_ms, speech_ms, speech_ms,
+                    checked_ms, channel_id])
+            self.__connection.execute("UPDATE job SET priority = (SELECT speech_yield FROM channel WHERE channel_id = ?) WHERE ((kind = 'channel' AND key = ?) OR (kind = 'video' AND channel_id = ?)) AND status = ?",
+                [channel_id, channel_id, channel_id, self.STATUS_NEW])
+
+    def prune_channels(self, min_checked, min_yield):
+        """
+        Stop crawling channels with a subtitle yield below `min_yield` after
+        `min_checked` videos, dropping their listing and video jobs left, and
+        return the number of channels pruned.
+        """
+        with self.__write_lock() as connection:
+            cursor = connection.execute('UPDATE channel SET status = ? WHERE status IN (?, ?) AND num_checked >= ? AND speech_yield < ?',
+                [self.STATUS_PRUNED, self.STATUS_NEW, self.STATUS_QUEUED,
+                    min_checked, min_yield])
+            if cursor.rowcount > 0:
+                connection.execute("UPDATE job SET status = ?, owner = NULL, lease_expire = NULL WHERE status = ? AND ((kind = 'channel' AND key IN (SELECT channel_id FROM channel WHERE status = ?)) OR (kind = 'video' AND channel_id IN (SELECT channel_id FROM channel WHERE status = ?)))",
+                    [self.STATUS_PRUNED, self.STATUS_NEW, self.STATUS_PRUNED,
+                        self.STATUS_PRUNED])
+        return cursor.rowcount
+
     def set_channel_wip(self, channel_id, wip):
         cursor = self.__connection.cursor()
         cursor.execute('UPDATE channel SET wip = ? WHERE channel_id = ?',
             [wip, channel_id])
         assert cursor.rowcount == 1
-        self.__connection.commit()
+        self.__commit()
 
     def set_channel_done(self, channel_id):
         cursor = self.__connection.cursor()
         cursor.execute('UPDATE channel SET status = ? WHERE channel_id = ?',
             [self.STATUS_DONE, channel_id])
         assert cursor.rowcount == 1
-        self.__connection.commit()
+        self.__commit()
 
     def add_video(self, video_id, channel_id):
         cursor = self.__connection.cursor()
-        try:
-            cursor.execute('INSERT INTO video (video_id, channel_id, status) VALUES (?, ?, ?)',
-                [video_id, channel_id, self.STATUS_DOWNLOADED])
-            assert cursor.rowcount == 1
-            self.__connection.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
+        # A failed INSERT would leave the transaction, and the write lock,
+        # open until the next commit.
+        cursor.execute('INSERT OR IGNORE INTO video (video_id, channel_id, status) VALUES (?, ?, ?)',
+            [video_id, channel_id, self.STATUS_DOWNLOADED])
+        self.__commit()
+        return cursor.rowcount == 1
 
     def fetch_new_videos(self):
         cursor = self.__connection.cursor()
-        cursor.execute('SELECT video_id, channel_id FROM video WHERE status = ? SORT BY create_time ASC')
+        cursor.execute('SELECT video_id, channel_id FROM video WHERE status = ? ORDER BY create_time ASC',
+            [self.STATUS_NEW])
         return cursor.fetchall()
 
     def set_video_status(self, video_id, status):
         cursor = self.__connection.cursor()
         cursor.execute('UPDATE video SET status = ? WHERE video_id = ?',
-            [video_id, status])
+            [status, video_id])
         assert cursor.rowcount == 1
-        self.__connection.commit()
+        self.__commit()
 
     def set_video_length(self, video_id, length):
         cursor = self.__connection.cursor()
         cursor.execute('UPDATE video SET length = ? WHERE video_id = ?',
             [length, video_id])
         assert cursor.rowcount == 1
-        self.__connection.commit()
+        self.__commit()
 
     def add_subtitle(self, video_id, content, start_time, end_time,
             aligned=True):
         cursor = self.__connection.cursor()
         cursor.execute('INSERT INTO subtitle (video_id, content, aligned, start_time, end_time) VALUES (?, ?, ?, ?, ?)',
-            [video_id, content, start_time, end_time, 1 if aligned else 0])
+            [video_id, content, 1 if aligned else 0, start_time, end_time])
         assert cursor.rowcount == 1
-        self.__connection.commit()
+        self.__commit()
 
-    def __create_db(self, filename):
-        connection = sqlite3.connect(filename)
+    def add_subtitles_bulk(self, video_id, subtitles, aligned=True):
+        """
+        Insert (content, start_time, end_time) tuples in one statement.
+        """
+        aligned = 1 if aligned else 0
+        cursor = self.__connection.cursor()
+        cursor.executemany('INSERT INTO subtitle (video_id, content, aligned, start_time, end_time) VALUES (?, ?, ?, ?, ?)',
+            ((video_id, content, aligned, start_time, end_time)
+                for content, start_time, end_time in subtitles))
+        self.__commit()
 
-        cursor = connection.cursor()
-        cursor.execute("""CREATE TABLE search (
-            query VARCHAR(255) PRIMARY KEY,
-            status INT NOT NULL,
-            wip TEXT,
-            create_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            update_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
-        )""")
+    def queue_jobs(self, kind, key, items, priority=0.0):
+        """
+        Add a job for each of `items` of `key`, e.g. the pages of a search
+        query, and set the status of `key` to STATUS_QUEUED. Returns False
+        without adding anything if `key` is no longer STATUS_NEW, e.g.
+        because another crawler queued it first.
+        """
+        table, column = self.JOB_KINDS[kind]
+        with self.__write_lock() as connection:
+            cursor = connection.execute(
+                f'UPDATE {table} SET status = ? WHERE {column} = ? AND status = ?',
+                [self.STATUS_QUEUED, key, self.STATUS_NEW])
+            if cursor.rowcount == 0:
+                return False
+            connection.executemany('INSERT OR IGNORE INTO job (kind, key, item, status, priority) VALUES (?, ?, ?, ?, ?)',
+                ((kind, key, item, self.STATUS_NEW, priority)
+                    for item in items))
+            if not self.__has_pending_jobs(kind, key):
+                self.__set_key_done(kind, key)
+        return True
 
-        cursor.execute("""CREATE TABLE channel (
-            channel_id VARCHAR(255) PRIMARY KEY,
-            status INT NOT NULL,
-            wip TEXT,
-            size INT,
-            num_checked INT NOT NULL DEFAULT 0,
-            num_valid INT NOT NULL DEFAULT 0,
-            create_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            update_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
-        )""")
+    def claim_jobs(self, kind, owner, lease_seconds, limit=1):
+        """
+        Lease up to `limit` jobs of `kind` to `owner` for `lease_seconds`,
+        highest priority first, and return their (key, item) pairs. Jobs
+        whose lease expired are claimed again. Two owners never get the
+        same job as long as SQLite locking works, i.e. when they all run on
+        the host storing the database.
+        """
+        now = time.time()
+        with self.__write_lock() as connection:
+            rows = connection.execute('SELECT job_id, key, item FROM job WHERE status = ? AND kind = ? AND (lease_expire IS NULL OR lease_expire < ?) ORDER BY priority DESC, job_id ASC LIMIT ?',
+                [self.STATUS_NEW, kind, now, limit]).fetchall()
+            connection.executemany('UPDATE job SET owner = ?, lease_expire = ?, attempts = attempts + 1, update_time = CURRENT_TIMESTAMP WHERE job_id = ?',
+                ((owner, now + lease_seconds, job_id) for job_id, _, _ in rows))
+        return [(key, item) for _, key, item in rows]
 
-        cursor.execute("""CREATE TABLE video (
-            video_id VARCHAR(255) PRIMARY KEY,
-            status INT NOT NULL,
-            channel_id VARCHAR(255),
-            file VARCHAR(255),
-            length INT,
-            publish_time DATETIME,
-            create_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            update_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
-        )""")
+    def renew_leases(self, owner, lease_seconds):
+        """
+        Extend all leases of `owner`, returning the number of jobs it holds.
+        """
+        with self.__write_lock() as connection:
+            cursor = connection.execute('UPDATE job SET lease_expire = ? WHERE owner = ? AND status = ?',
+                [time.time() + lease_seconds, owner, self.STATUS_NEW])
+        return cursor.rowcount
 
-        cursor.execute("""CREATE TABLE subtitle (
-            subtitle_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            video_id VARCHAR(255) NOT NULL,
-            aligned INT NOT NULL,
-            start_time INT NOT NULL,
-            end_time INT NOT NULL,
-            content TEXT NOT NULL,
-            create_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            update_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            
-            FOREIGN KEY (video_id) REFERENCES video(video_id)
-                ON DELETE CASCADE ON UPDATE CASCADE
-        )""")
+    def complete_job(self, kind, key, item, owner):
+        """
+        Mark a job leased by `owner` done, and the search, channel or video
+        behind it once none of its jobs are left. Returns False if the job
+        is no longer leased by `owner`.
+        """
+        with self.__write_lock() as connection:
+            cursor = connection.execute('UPDATE job SET status = ?, owner = NULL, lease_expire = NULL, update_time = CURRENT_TIMESTAMP WHERE kind = ? AND key = ? AND item = ? AND owner = ?',
+                [self.STATUS_DONE, kind, key, item, owner])
+            if cursor.rowcount == 0:
+                return False
+            if not self.__has_pending_jobs(kind, key):
+                self.__set_key_done(kind, key)
+        return True
+
+    def fail_job(self, kind, key, item, owner, max_attempts):
+        """
+        Release a job leased by `owner` whose download failed, so that it
+        is claimed again, or mark it STATUS_UNKNOWN_ERROR once it was
+        claimed `max_attempts` times. Returns False if the job is no longer
+        leased by `owner`.
+        """
+        with self.__write_lock() as connection:
+            cursor = connection.execute('UPDATE job SET status = CASE WHEN attempts >= ? THEN ? ELSE status END, owner = NULL, lease_expire = NULL, update_time = CURRENT_TIMESTAMP WHERE kind = ? AND key = ? AND item = ? AND owner = ? AND status = ?',
+                [max_attempts, self.STATUS_UNKNOWN_ERROR, kind, key, item,
+                    owner, self.STATUS_NEW])
+            if cursor.rowcount == 0:
+                return False
+            if not self.__has_pending_jobs(kind, key):
+                self.__set_key_done(kind, key)
+        return True
+
+    def release_jobs(self, owner):
+        """
+        Give up the unfinished jobs of `owner`, so that other crawlers can
+        claim them right away.
+        """
+        with self.__write_lock() as connection:
+            connection.execute('UPDATE job SET owner = NULL, lease_expire = NULL WHERE owner = ? AND status = ?',
+                [owner, self.STATUS_NEW])
 
+    def has_pending_work(self):
+        """
+        Whether there are unfinished jobs, leased or not, or searches and
+        channels not queued yet.
+        """
+        row = self.__connection.execute('SELECT EXISTS (SELECT 1 FROM job WHERE status = ?) OR EXISTS (SELECT 1 FROM search WHERE status = ?) OR EXISTS (SELECT 1 FROM channel WHERE status = ?)',
+            [self.STATUS_NEW] * 3).fetchone()
+        return row[0] == 1
+
+    def __has_pending_jobs(self, kind, key):
+        row = self.__connection.execute('SELECT EXISTS (SELECT 1 FROM job WHERE kind = ? AND key = ? AND status = ?)',
+            [kind, key, self.STATUS_NEW]).fetchone()
+        return row[0] == 1
+
+    def __set_key_done(self, kind, key):
+        # Videos queued from a channel listing have no row until they are
+        # processed, and processing sets their status.
+        table, column = self.JOB_KINDS[kind]
+        self.__connection.execute(
+            f'UPDATE {table} SET status = ? WHERE {column} = ? AND status = ?',
+            [self.STATUS_DONE, key, self.STATUS_QUEUED])
+
+    def __commit(self):
+        if self.__batch_depth == 0:
+            self.__connection.commit()
+
+    @contextlib.contextmanager
+    def __write_lock(self):
+        """
+        Run the block in a transaction taking the write lock up front, so
+        that nothing it read changes before its writes commit, even with
+        other processes writing to the database.
+        """
+        assert self.__batch_depth == 0
+        connection = self.__connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
         connection.commit()
 
-        return connection
+    def __migrate(self):
+        """
+        Upgrade the schema to the latest version in MIGRATIONS. The version
+        is read without locking first, so opening an up to date database
+        doesn't contend for the write lock. An upgrade runs in a write
+        transaction that checks the version again, so processes opening
+        the database at the same time don't apply a migration twice.
+        """
+        if self.__schema_version() == len(MIGRATIONS):
+            return
+        with self.__write_lock() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS schema_version (version INT NOT NULL)')
+            version = self.__schema_version()
+            for target in range(version + 1, len(MIGRATIONS) + 1):
+                for statement in MIGRATIONS[target - 1]:
+                    connection.execute(statement)
+                connection.execute(
+                    'INSERT INTO schema_version (version) VALUES (?)', [target])
+
+    def __schema_version(self):
+        row = self.__connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'").fetchone()
+        if row is None:
+            return 0
+        row = self.__connection.execute(
+            'SELECT MAX(version) FROM schema_version').fetchone()
+        return row[0] or 0
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+A stand-in for the forced alignment service, for tests and benchmarks.
+It spreads the words of the transcript evenly over the audio and reports
+all of them as successfully aligned.
+"""
+
+import argparse
+import email.parser
+import http.server
+import json
+import random
+import socketserver
+import struct
+import threading
+import time
+
+
+def parse_multipart(content_type, body):
+    message = email.parser.BytesParser().parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n'
+        + body)
+    fields = {}
+    for part in message.get_payload():
+        name = part.get_param('name', header='content-disposition')
+        fields[name] = part.get_payload(decode=True)
+    return fields
+
+
+def wav_duration(wav_data):
+    _, _, _, _, _, _, _, _, byte_rate, _, _, _, data_size = \
+        struct.unpack_from('<4sI4s4sIHHIIHH4sI', wav_data)
+    return data_size / byte_rate
+
+
+def fake_alignment(transcript, duration):
+    words = transcript.split()
+    step = duration / max(len(words), 1)
+    offset = 0
+    result = []
+    for i, word in enumerate(words):
+        offset = transcript.index(word, offset)
+        result.append({
+            'word': word,
+            'alignedWord': word.lower(),
+            'case': 'success',
+            'start': round(i * step, 2),
+            'end': round((i + 1) * step, 2),
+            'startOffset': offset,
+            'endOffset': offset + len(word),
+        })
+        offset += len(word)
+    return {'transcript': transcript, 'words': result}
+
+
+class AlignerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            self.__reply(503, {'error': 'simulated failure'})
+            return
+        fields = parse_multipart(self.headers['Content-Type'], body)
+        transcript = fields['transcript'].decode('utf-8')
+        self.__reply(200,
+            fake_alignment(transcript, wav_duration(fields['audio'])))
+
+    def log_message(self, format, *args):
+        pass
+
+    def __reply(self, status, content):
+        data = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeAligner(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0):
+        super().__init__(('127.0.0.1', port), AlignerHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('--latency', type=float, default=0.0,
+        help='Seconds to wait before answering each request.')
+    p.add_argument('--error-rate', type=float, default=0.0,
+        help='Fraction of requests answered with HTTP 503.')
+    cmdline = p.parse_args()
+    server = FakeAligner(cmdline.port, cmdline.latency, cmdline.error_rate)
+    print(f'Listening on {server.url}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,3 @@
-from .filters import load_and_filter
+from .filters import load_and_filter, filter_captions
+from .captions import Caption, CaptionColumns
+from .profiles import PROFILES
@@ -0,0 +1,97 @@
+import datetime
+import itertools
+
+
+def ms_to_time(ms):
+    seconds, ms = divmod(ms, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return datetime.time(hours, minutes, seconds, ms * 1000)
+
+
+def time_to_ms(ts):
+    return ts.hour * 3600000 + ts.minute * 60000 + ts.second * 1000 \
+        + ts.microsecond // 1000
+
+
+class Caption:
+    """
+    A subtitle caption with integer millisecond timestamps. This is what
+    the filter pipeline works on; to_dict() converts it to the dict format
+    returned by load_all_subtitles().
+    """
+    __slots__ = ('start_ms', 'end_ms', 'text', 'idx')
+
+    def __init__(self, start_ms, end_ms, text, idx=0):
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.text = text
+        self.idx = idx
+
+    @property
+    def duration_ms(self):
+        return self.end_ms - self.start_ms
+
+    def to_dict(self, sub_file=''):
+        return {
+            'ts_start': ms_to_time(self.start_ms),
+            'ts_end': ms_to_time(self.end_ms),
+            'original_phrase': self.text,
+            'sub_file': sub_file,
+            'duration': self.duration_ms / 1000,
+            'idx': self.idx,
+        }
+
+    @classmethod
+    def from_dict(cls, sub):
+        return cls(time_to_ms(sub['ts_start']), time_to_ms(sub['ts_end']),
+            sub['original_phrase'], sub.get('idx', 0))
+
+    def __eq__(self, other):
+        if not isinstance(other, Caption):
+            return NotImplemented
+        return (self.start_ms, self.end_ms, self.text, self.idx) == \
+            (other.start_ms, other.end_ms, other.text, other.idx)
+
+    def __repr__(self):
+        return f'Caption({self.start_ms}, {self.end_ms}, {self.text!r}, {self.idx})'
+
+
+def to_legacy(data, sub_file=''):
+    """
+    Convert pipeline data holding Caption objects to the dict based format
+    load_and_filter() used to return.
+    """
+    result = dict(data)
+    result['subtitles'] = [c.to_dict(sub_file) for c in data['subtitles']]
+    return result
+
+
+class CaptionColumns:
+    """
+    Captions stored as one list per field, for filters evaluated over whole
+    columns at once.
+    """
+    __slots__ = ('start_ms', 'end_ms', 'text', 'idx')
+
+    def __init__(self, start_ms, end_ms, text, idx):
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.text = text
+        self.idx = idx
+
+    @classmethod
+    def from_captions(cls, captions):
+        return cls([c.start_ms for c in captions], [c.end_ms for c in captions],
+            [c.text for c in captions], [c.idx for c in captions])
+
+    def to_captions(self):
+        return list(map(Caption, self.start_ms, self.end_ms, self.text,
+            self.idx))
+
+    def compress(self, mask):
+        return CaptionColumns(*(list(itertools.compress(column, mask))
+            for column in (self.start_ms, self.end_ms, self.text, self.idx)))
+
+    def __len__(self):
+        return len(self.text)
@@ -1,25 +1,125 @@
 # This file is mostly copied from https://github.com/EgorLakomkin/KTSpeechCrawler/blob/master/crawler/filters.py
 
+import functools
+import itertools
+import operator
 import re
+import time
 
-from .youtube_helpers import remove_overlapping_subtitles, \
-    normalize_subtitle, leave_alphanum_characters, merge_subtitles, load_all_subtitles
+from .youtube_helpers import remove_overlapping_captions, merge_captions, \
+    load_captions, find_overlapping_captions, merge_caption_columns, \
+    iter_non_overlapping_captions, iter_merged_captions
+from . import normalizer
+from .captions import to_legacy, CaptionColumns
+from .parsers import iter_captions
+from .profiles import get_profile
 
 
 class Pipeline:
     """
     Pipeline class storing and applying list of filters to the input video
+
+    Every mode takes an optional `observe` callback, called for each filter
+    with its class name, the seconds spent in it and the number of captions
+    going in and out of it.
     """
     def __init__(self,  lst_components):
         super(Pipeline, self).__init__()
         self.lst_components = lst_components
 
-    def __call__(self, data):
+    def __call__(self, data, observe=None):
         result = data
         for component in self.lst_components:
+            if observe is None:
+                result = component(result)
+                continue
+            captions_in = len(result['subtitles'])
+            start = time.perf_counter()
             result = component(result)
+            observe(type(component).__name__, time.perf_counter() - start,
+                captions_in, len(result['subtitles']))
         return result
 
+    def batch(self, data, observe=None):
+        """
+        Like __call__(), but run the filters on the columns of all captions
+        at once. The masks of consecutive predicate filters are combined,
+        each predicate only being evaluated for the captions still kept, and
+        the captions are dropped just before the next transform.
+        """
+        columns = CaptionColumns.from_captions(data['subtitles'])
+        mask = None
+        kept = len(columns)
+        for component in self.lst_components:
+            start = time.perf_counter()
+            captions_in = kept
+            if isinstance(component, PredicateFilter):
+                mask = component.mask(columns, mask)
+                if observe is not None:
+                    kept = mask.count(True)
+            else:
+                if mask is not None:
+                    columns = columns.compress(mask)
+                    mask = None
+                columns = component.batch(columns)
+                kept = len(columns)
+            if observe is not None:
+                observe(type(component).__name__,
+                    time.perf_counter() - start, captions_in, kept)
+        if mask is not None:
+            columns = columns.compress(mask)
+        data['subtitles'] = columns.to_captions()
+        return data
+
+    def stream(self, captions, observe=None):
+        """
+        Chain the filters as generators over the `captions` iterable. Only
+        the overlap remover and the merger hold captions back, a few at a
+        time, so memory does not grow with the number of captions.
+
+        With `observe`, the captions coming out of `captions` itself are
+        reported as a 'load' stage once the stream is exhausted.
+        """
+        if observe is None:
+            for component in self.lst_components:
+                captions = component.stream(captions)
+            return captions
+        return self.__observed_stream(captions, observe)
+
+    def __observed_stream(self, captions, observe):
+        stages = [ObservedIterator(captions)]
+        for component in self.lst_components:
+            stages.append(ObservedIterator(component.stream(stages[-1])))
+        yield from stages[-1]
+        observe('load', stages[0].seconds, stages[0].count, stages[0].count)
+        for component, before, after in zip(self.lst_components, stages,
+                stages[1:]):
+            observe(type(component).__name__, after.seconds - before.seconds,
+                before.count, after.count)
+
+
+class ObservedIterator:
+    """
+    Count the items taken from an iterator, and the time spent producing
+    them, including the time spent in the iterators it pulls from.
+    """
+    def __init__(self, iterable):
+        self.__iterator = iter(iterable)
+        self.count = 0
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            item = next(self.__iterator)
+        finally:
+            self.seconds += time.perf_counter() - start
+        self.count += 1
+        return item
+
 
 class BaseFilter:
     def validate(self, input):
@@ -28,6 +128,70 @@ class BaseFilter:
     def __call__(self, input):
         raise NotImplementedError
 
+    def batch(self, columns):
+        raise NotImplementedError
+
+    def stream(self, captions):
+        raise NotImplementedError
+
+
+class PredicateFilter(BaseFilter):
+    """
+    A filter keeping the captions for which test() is true. test() is called
+    with the value() of each caption, or the values() of a whole column.
+    """
+    def value(self, caption):
+        return caption.text
+
+    def values(self, columns):
+        return columns.text
+
+    def test(self, value):
+        raise NotImplementedError
+
+    def mask(self, columns, keep=None):
+        """
+        Test the captions of `columns`, or only those with a true `keep`
+        entry, so that values() isn't computed for dropped captions.
+        """
+        test = self.test
+        if keep is None or all(keep):
+            return [test(v) for v in self.values(columns)]
+        results = iter([test(v) for v in self.values(columns.compress(keep))])
+        return [k and next(results) for k in keep]
+
+    def __call__(self, input):
+        subtitles = input['subtitles']
+        mask = self.mask(CaptionColumns.from_captions(subtitles))
+        input['subtitles'] = list(itertools.compress(subtitles, mask))
+        return input
+
+    def stream(self, captions):
+        test, value = self.test, self.value
+        return (c for c in captions if test(value(c)))
+
+
+class TextTransform(BaseFilter):
+    """
+    A filter replacing the text of every caption with transform(text).
+    """
+    def transform(self, text):
+        raise NotImplementedError
+
+    def __call__(self, input):
+        for sub_info in input['subtitles']:
+            sub_info.text = self.transform(sub_info.text)
+        return input
+
+    def batch(self, columns):
+        columns.text = list(map(self.transform, columns.text))
+        return columns
+
+    def stream(self, captions):
+        for caption in captions:
+            caption.text = self.transform(caption.text)
+            yield caption
+
 
 class OverlappingSubtitlesRemover(BaseFilter):
     def __init__(self):
@@ -35,9 +199,20 @@ class OverlappingSubtitlesRemover(BaseFilter):
 
     def __call__(self, input):
         subtitles = input['subtitles']
-        input['subtitles'] = remove_overlapping_subtitles(subtitles)
+        input['subtitles'] = remove_overlapping_captions(subtitles)
         return input
 
+    def batch(self, columns):
+        bad_indices = find_overlapping_captions(columns.start_ms,
+            columns.end_ms)
+        if not bad_indices:
+            return columns
+        return columns.compress(
+            [i not in bad_indices for i in range(len(columns))])
+
+    def stream(self, captions):
+        return iter_non_overlapping_captions(captions)
+
 
 class SubtitleMerger(BaseFilter):
     def __init__(self, min_gap_to_split_sec = 1.0, max_len_merged_sec = 15):
@@ -47,25 +222,31 @@ class SubtitleMerger(BaseFilter):
 
     def __call__(self, input):
         subtitles = input['subtitles']
-        input['subtitles'] = merge_subtitles(subtitles, min_dist=self.min_gap_to_split_sec,
-                                             max_dist=self.max_len_merged_sec)
+        input['subtitles'] = merge_captions(subtitles, min_dist=self.min_gap_to_split_sec,
+                                            max_dist=self.max_len_merged_sec)
         return input
 
+    def batch(self, columns):
+        return merge_caption_columns(columns, min_dist=self.min_gap_to_split_sec,
+                                     max_dist=self.max_len_merged_sec)
+
+    def stream(self, captions):
+        return iter_merged_captions(captions, min_dist=self.min_gap_to_split_sec,
+                                    max_dist=self.max_len_merged_sec)
+
 
 DEFAULT_BLACKLIST_CHARACTERS = {"♪", "♬", "♫"}
 
 
-class SubtitleCaptionTextFilter(BaseFilter):
+class SubtitleCaptionTextFilter(PredicateFilter):
     def __init__(self, blacklisted_chars=None):
         super(SubtitleCaptionTextFilter, self).__init__()
         self.blacklist_chars = blacklisted_chars or DEFAULT_BLACKLIST_CHARACTERS
+        self.blacklist_regexp = re.compile('|'.join(
+            re.escape(c) for c in sorted(self.blacklist_chars)))
 
-    def __call__(self, input):
-        subtitles = input['subtitles']
-        input['subtitles'] = list(filter(lambda s: all(s['original_phrase'].find(c) == -1
-                                                  for c in self.blacklist_chars),
-                                                  subtitles))
-        return input
+    def test(self, text):
+        return self.blacklist_regexp.search(text) is None
 
 
 class MinNumberSubtitlesFilter(BaseFilter):
@@ -79,107 +260,154 @@ class MinNumberSubtitlesFilter(BaseFilter):
         return len(input['subtitles']) > self.threshold
 
 
-class CaptionRegexMatcher(BaseFilter):
+class CaptionRegexMatcher(PredicateFilter):
     def __init__(self, regexp):
         super(CaptionRegexMatcher, self).__init__()
-        self.regexp = regexp
+        self.regexp = re.compile(regexp)
 
-    def __call__(self, input):
-        subtitles = input['subtitles']
-        input['subtitles'] = list(filter(lambda s: re.match(self.regexp, s['original_phrase']) is not None, subtitles))
-        return input
+    def test(self, text):
+        return self.regexp.match(text) is not None
 
 
-class CaptionNormalizer(BaseFilter):
-    def __call__(self, input):
-        for sub_info in input['subtitles']:
-            sub_info['original_phrase'] =  normalize_subtitle(sub_info["original_phrase"])
-        return input
+class CaptionTextCheck(PredicateFilter):
+    def __init__(self, check):
+        super(CaptionTextCheck, self).__init__()
+        self.check = check
 
+    def test(self, text):
+        return self.check(text)
 
-class CaptionLengthFilter(BaseFilter):
 
-    def __init__(self, min_length=None, max_length=None):
+class CaptionNormalizer(TextTransform):
+    def __init__(self, normalize=normalizer.normalize):
+        super(CaptionNormalizer, self).__init__()
+        self.normalize = normalize
+
+    def transform(self, text):
+        return self.normalize(text)
+
+
+class CaptionLengthFilter(PredicateFilter):
+    """
+    Keep the captions with at least `min_length` and at most `max_length`
+    words, or non-space characters with `characters`. A missing or zero
+    bound is not checked.
+    """
+    def __init__(self, min_length=None, max_length=None, characters=False):
         super(CaptionLengthFilter, self).__init__()
-        self.min_filter_func = lambda x: len(x.split()) >= min_length if min_length else lambda x: True
-        self.max_filter_func = lambda x: len(x.split()) <= max_length if max_length else lambda x: True
+        self.min_length = min_length
+        self.max_length = max_length
+        self.characters = characters
 
+    def length(self, text):
+        if self.characters:
+            return sum(map(len, text.split()))
+        return len(text.split())
 
-    def __call__(self, input):
-        subtitles = input['subtitles']
-        input['subtitles'] = list(filter(lambda s: self.min_filter_func(s['original_phrase'])
-                                  and self.max_filter_func(s['original_phrase']), subtitles))
-        return input
+    def value(self, caption):
+        return self.length(caption.text)
 
+    def values(self, columns):
+        return list(map(self.length, columns.text))
 
-class CaptionDurationFilter(BaseFilter):
+    def test(self, words):
+        if self.min_length and words < self.min_length:
+            return False
+        if self.max_length and words > self.max_length:
+            return False
+        return True
+
+
+class CaptionDurationFilter(PredicateFilter):
+    """
+    Keep the captions lasting at least `min_length` and at most `max_length`
+    seconds. A missing or zero bound is not checked.
+    """
     def __init__(self, min_length=None, max_length=None):
         super(CaptionDurationFilter, self).__init__()
-        self.min_filter_func = lambda x: x['duration'] >= min_length if min_length else lambda x: True
-        self.max_filter_func = lambda x: x['duration'] <= max_length if max_length else lambda x: True
+        self.min_length_ms = min_length * 1000 if min_length else None
+        self.max_length_ms = max_length * 1000 if max_length else None
 
-    def __call__(self, input):
-        subtitles = input['subtitles']
-        input['subtitles'] = list(filter(lambda s: self.min_filter_func(s)
-                                  and self.max_filter_func(s), subtitles))
-        return input
+    def value(self, caption):
+        return caption.duration_ms
 
+    def values(self, columns):
+        return list(map(operator.sub, columns.end_ms, columns.start_ms))
 
-class CaptionLeaveOnlyAlphaNumCharacters(BaseFilter):
-    def __call__(self, input):
-        for sub_info in input['subtitles']:
-            sub_info['original_phrase'] =  leave_alphanum_characters(sub_info["original_phrase"])
-        return input
+    def test(self, duration_ms):
+        if self.min_length_ms is not None and duration_ms < self.min_length_ms:
+            return False
+        if self.max_length_ms is not None and duration_ms > self.max_length_ms:
+            return False
+        return True
 
 
-def load_and_filter(filename):
-    subtitles = load_all_subtitles(filename)
-    print(len(subtitles))
-    src = {
-        'subtitles': subtitles,
-        'video_file': ''
-    }
-    good_chars_regexp = re.compile(
-        r"^[A-Za-z0-9\,\.\-\?\"\'\’\!\“\s\;\:\“\”\–\‘\’\’\/\\]+$",
-        re.IGNORECASE)
-    pipeline = Pipeline([
+class CaptionLeaveOnlyAlphaNumCharacters(TextTransform):
+    def __init__(self, leave_alphanum=normalizer.leave_alphanum):
+        super(CaptionLeaveOnlyAlphaNumCharacters, self).__init__()
+        self.leave_alphanum = leave_alphanum
+
+    def transform(self, text):
+        return self.leave_alphanum(text)
+
+
+@functools.lru_cache(maxsize=None)
+def default_pipeline(lang='en'):
+    """
+    The pipeline used by load_and_filter() for the language `lang`. It is
+    built once per process and language; the filters keep no state between
+    calls.
+    """
+    profile = get_profile(lang)
+    return Pipeline([
         OverlappingSubtitlesRemover(),
         SubtitleCaptionTextFilter(),
-        CaptionNormalizer(),
-        CaptionRegexMatcher(good_chars_regexp),
-        CaptionLengthFilter(min_length=5),
-        CaptionLeaveOnlyAlphaNumCharacters(),
+        CaptionTextCheck(profile.may_pass),
+        CaptionNormalizer(profile.normalize),
+        CaptionRegexMatcher(profile.good_chars),
+        CaptionLengthFilter(min_length=profile.min_length,
+                            characters=profile.length_in_chars),
+        CaptionLeaveOnlyAlphaNumCharacters(profile.leave_alphanum),
         SubtitleMerger(max_len_merged_sec=10),
         CaptionDurationFilter(min_length=1, max_length=20.0)
     ])
-    return pipeline(src)
+
+
+def filter_captions(captions, lang='en', observe=None):
+    """
+    Run the Caption objects from the `captions` iterable through the
+    default pipeline of `lang`, returning the list of those that pass.
+    """
+    return list(default_pipeline(lang).stream(captions, observe))
+
+
+def load_and_filter(filename, compact=False, lang='en', observe=None):
+    """
+    Load and filter the subtitles of a video in the language `lang`, which
+    selects one of profiles.PROFILES. The subtitles are returned as
+    Caption objects with `compact`, or as dicts like the ones returned by
+    load_all_subtitles() otherwise. The file is parsed and filtered as a
+    stream, so only the captions that pass are ever held in memory.
+    """
+    result = {
+        'subtitles': filter_captions(iter_captions(filename), lang, observe),
+        'video_file': ''
+    }
+    if compact:
+        return result
+    return to_legacy(result, filename)
 
 
 def test():
     import sys
 
-    from .youtube_helpers import load_all_subtitles
-
-    subtitles = load_all_subtitles(sys.argv[1])
+    subtitles = load_captions(sys.argv[1])
     print(len(subtitles))
     input = {
         'subtitles': subtitles,
         'video_file': ''
     }
-    good_chars_regexp = re.compile(
-        r"^[A-Za-z0-9\,\.\-\?\"\'\’\!\“\s\;\:\“\”\–\‘\’\’\/\\]+$",
-        re.IGNORECASE)
-    pipeline = Pipeline([
-        OverlappingSubtitlesRemover(),
-        SubtitleCaptionTextFilter(),
-        CaptionNormalizer(),
-        CaptionRegexMatcher(good_chars_regexp),
-        CaptionLengthFilter(min_length=5),
-        CaptionLeaveOnlyAlphaNumCharacters(),
-        SubtitleMerger(max_len_merged_sec=10),
-        CaptionDurationFilter(min_length=1, max_length=20.0)
-    ])
-    processed_subtitles = pipeline(input)
+    processed_subtitles = default_pipeline()(input)
     print(len(processed_subtitles['subtitles']))
     for s in processed_subtitles['subtitles']:
         print(s)
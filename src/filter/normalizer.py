@@ -0,0 +1,71 @@
+"""
+Precompiled versions of normalize_subtitle() and leave_alphanum_characters()
+from youtube_helpers, producing the same output in fewer passes. Passes
+that cannot change the text are skipped, and results are memoized since
+auto-generated subtitles repeat a lot of phrases.
+"""
+
+import functools
+import re
+import unicodedata
+
+from .youtube_helpers import int_to_en
+
+PUNCTUATION = str.maketrans({
+    ',': ' ', '.': ' ',
+    '’': '\'', '‘': '\'', 'ʻ': '\'', '´': '\'',
+})
+HYPHENATED = re.compile(r"([a-z])\-([a-z])", re.IGNORECASE)
+# Replacing "- " and then "— " also removes "—- " as a whole
+DASHES = re.compile('—?- |— ')
+TAGS = re.compile('<[^<]+?>')
+SPEAKER = re.compile(r"[A-Z]\w+\:")
+BRACKETED = (
+    ('[', re.compile(r'\[.*\]')),
+    ('(', re.compile(r'\(.*\)')),
+    ('*', re.compile(r'\*.*\*')),
+)
+NUMBER = re.compile(r'\s([\d]+)\s')
+NUMBER_WORDS = tuple(int_to_en(i) for i in range(1000))
+NOT_ALPHA = re.compile(r"[^a-z\']+", re.IGNORECASE)
+NON_ASCII = re.compile('[^\x00-\x7f]')
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def normalize(text):
+    """
+    Same as normalize_subtitle(text).
+    """
+    text = (' ' + text + ' ').translate(PUNCTUATION)
+    if '-' in text:
+        text = HYPHENATED.sub(r"\1\2", text)
+        text = DASHES.sub(' ', text)
+    elif '—' in text:
+        text = text.replace('— ', ' ')
+    if '&' in text:
+        text = text.replace('&nbsp;', ' ')
+    if '<' in text:
+        text = TAGS.sub(' ', text)
+    if ':' in text:
+        text = SPEAKER.sub(' ', text)
+    for char, regexp in BRACKETED:
+        if char in text:
+            text = regexp.sub(' ', text)
+    if NON_ASCII.search(text):
+        text = unicodedata.normalize('NFKD', text)
+
+    if '%' in text:
+        text = text.replace('%', ' percent ')
+    for number in NUMBER.findall(text):
+        if len(number) <= 3:
+            text = text.replace(number, NUMBER_WORDS[int(number)])
+    return text.strip()
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def leave_alphanum(text):
+    """
+    Same as leave_alphanum_characters(text): every run of characters other
+    than letters and apostrophes becomes a single space.
+    """
+    return NOT_ALPHA.sub(' ', text.lower()).upper().strip()
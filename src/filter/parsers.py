@@ -0,0 +1,205 @@
+"""
+Streaming WebVTT and TTML parsers producing Caption objects with integer
+millisecond timestamps.
+
+The WebVTT parser follows webvtt-py 0.4.3, which was used before: lines
+are stripped, blank lines separate blocks, the block holding the WEBVTT
+signature is skipped, NOTE and STYLE blocks are ignored, cue identifiers
+are skipped, cue settings after the end timestamp are ignored, cue text
+tags (e.g. YouTube's <c> and inline timestamps) are removed and cues
+without text are kept with empty text. Files webvtt-py rejects raise
+MalformedFileError or MalformedCaptionError, when the offending block is
+reached.
+"""
+
+import re
+import xml.etree.ElementTree as ElementTree
+
+from .captions import Caption
+
+
+class MalformedFileError(ValueError):
+    pass
+
+
+class MalformedCaptionError(ValueError):
+    pass
+
+
+CUE_TIMINGS = re.compile(
+    r'\s*((?:\d+:)?\d{2}:\d{2}.\d{3})\s*-->\s*((?:\d+:)?\d{2}:\d{2}.\d{3})')
+TIMESTAMP = re.compile(r'(\d+)?:?(\d{2}):(\d{2})[.,](\d{3})')
+COMMENT = re.compile(r'NOTE(?:\s.+|$)')
+STYLE = re.compile(r'STYLE[ \t]*$')
+CUE_TEXT_TAGS = re.compile('<.*?>')
+
+
+def parse_vtt_timestamp(value):
+    if len(value) == 12 and value[2] == ':' and value[5] == ':' \
+            and value[8] == '.':
+        hours, minutes = int(value[0:2]), int(value[3:5])
+        seconds, ms = int(value[6:8]), int(value[9:12])
+    else:
+        match = TIMESTAMP.match(value)
+        if match is None:
+            raise MalformedCaptionError(f'Invalid timestamp: {value}')
+        hours = int(match.group(1) or 0)
+        minutes, seconds, ms = (int(g) for g in match.group(2, 3, 4))
+    return ((hours * 60 + minutes) * 60 + seconds) * 1000 + ms
+
+
+def parse_vtt_block(lines, line_number, idx):
+    """
+    Return the Caption for a block of stripped, non-empty lines starting at
+    `line_number`, or None for a NOTE or STYLE block. `idx` is the number
+    of cues before the block.
+    """
+    if '-->' in lines[0] or (len(lines) > 1 and '-->' in lines[1]):
+        timings = None
+        payload = []
+        for i, line in enumerate(lines):
+            if '-->' in line:
+                if timings is not None:
+                    raise MalformedCaptionError(
+                        f'--> found in line {line_number + i}')
+                timings = CUE_TIMINGS.match(line)
+                if timings is None:
+                    raise MalformedCaptionError(
+                        f'Invalid time format in line {line_number + i}')
+            elif i > 0:
+                payload.append(line)
+        start, end = timings.groups()
+        text = CUE_TEXT_TAGS.sub('', '\n'.join(payload)).replace('\n', ' ')
+        return Caption(parse_vtt_timestamp(start), parse_vtt_timestamp(end),
+            text, idx)
+    if COMMENT.match(lines[0]):
+        return None
+    if STYLE.match(lines[0]):
+        if idx > 0:
+            raise MalformedFileError(
+                f'Style block defined after the first cue in line {line_number}.')
+        return None
+    if len(lines) == 1:
+        raise MalformedCaptionError(
+            f'Standalone cue identifier in line {line_number}.')
+    raise MalformedCaptionError(f'Missing timing cue in line {line_number + 1}.')
+
+
+def iter_vtt_captions(f):
+    """
+    Parse WebVTT text from the file object `f`, yielding one Caption per
+    cue without reading the whole file at once.
+    """
+    first = f.readline()
+    if not first:
+        raise MalformedFileError('The file is empty.')
+    if not first.lstrip('\ufeff').startswith('WEBVTT'):
+        raise MalformedFileError('The file does not have a valid format')
+    idx = 0
+    # The block holding the signature is never a cue.
+    in_header = True
+    block = []
+    line_number = 0
+    for number, line in enumerate(f, start=2):
+        line = line.strip()
+        if line:
+            if not in_header:
+                if not block:
+                    line_number = number
+                block.append(line)
+            continue
+        in_header = False
+        if block:
+            caption = parse_vtt_block(block, line_number, idx)
+            if caption is not None:
+                yield caption
+                idx += 1
+            block = []
+    if block:
+        caption = parse_vtt_block(block, line_number, idx)
+        if caption is not None:
+            yield caption
+
+
+TTML_OFFSET_TIME = re.compile(r'^([\d.]+)(h|m|s|ms|f|t)$')
+TTML_CLOCK_TIME = re.compile(r'^(\d+):(\d{2}):(\d{2})(?:(\.\d+)|:(\d+))?$')
+TTML_PARAMETER_NS = '{http://www.w3.org/ns/ttml#parameter}'
+
+
+def parse_ttml_time(value, frame_rate=30, tick_rate=1):
+    value = value.strip()
+    match = TTML_CLOCK_TIME.match(value)
+    if match:
+        hours, minutes, seconds, fraction, frames = match.groups()
+        ms = ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000
+        if fraction:
+            ms += round(float(fraction) * 1000)
+        elif frames:
+            ms += round(int(frames) * 1000 / frame_rate)
+        return ms
+    match = TTML_OFFSET_TIME.match(value)
+    if match is None:
+        raise ValueError(f'Invalid TTML time expression {value!r}')
+    number, unit = float(match.group(1)), match.group(2)
+    scale = {'h': 3600000, 'm': 60000, 's': 1000, 'ms': 1,
+        'f': 1000 / frame_rate, 't': 1000 / tick_rate}[unit]
+    return round(number * scale)
+
+
+def _local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def _ttml_text(element):
+    parts = [element.text or '']
+    for child in element:
+        if _local_name(child.tag) == 'br':
+            parts.append('\n')
+        else:
+            parts.append(_ttml_text(child))
+        parts.append(child.tail or '')
+    return ''.join(parts)
+
+
+def iter_ttml_captions(f):
+    """
+    Parse TTML from the file object `f`, yielding one Caption per <p>
+    element. Line breaks become spaces, like in the WebVTT parser.
+    """
+    frame_rate = 30
+    tick_rate = 1
+    idx = 0
+    for event, element in ElementTree.iterparse(f, events=('start', 'end')):
+        name = _local_name(element.tag)
+        if event == 'start':
+            if name == 'tt':
+                frame_rate = float(element.get(TTML_PARAMETER_NS + 'frameRate', 30))
+                tick_rate = float(element.get(TTML_PARAMETER_NS + 'tickRate', 1))
+            continue
+        if name != 'p' or element.get('begin') is None:
+            continue
+        start = parse_ttml_time(element.get('begin'), frame_rate, tick_rate)
+        if element.get('end') is not None:
+            end = parse_ttml_time(element.get('end'), frame_rate, tick_rate)
+        else:
+            end = start + parse_ttml_time(element.get('dur', '0s'),
+                frame_rate, tick_rate)
+        lines = (' '.join(line.split())
+            for line in _ttml_text(element).split('\n'))
+        text = ' '.join(line for line in lines if line)
+        element.clear()
+        if text:
+            yield Caption(start, end, text, idx)
+            idx += 1
+
+
+def iter_captions(filename):
+    """
+    Parse a .vtt or .ttml subtitle file, yielding Caption objects.
+    """
+    if filename.endswith('.ttml') or filename.endswith('.xml'):
+        with open(filename, 'rb') as f:
+            yield from iter_ttml_captions(f)
+    else:
+        with open(filename, encoding='utf-8-sig') as f:
+            yield from iter_vtt_captions(f)
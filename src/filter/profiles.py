@@ -0,0 +1,133 @@
+"""
+Language specific rules of the subtitle filter pipeline, selected with
+--lang. Every profile has a cheap check run on the raw caption text, which
+rejects captions that could never pass the rest of the pipeline before
+they are normalized.
+"""
+
+import re
+import unicodedata
+
+from . import normalizer
+
+
+class Profile:
+    def __init__(self, may_pass, normalize, good_chars, leave_alphanum,
+            min_length, length_in_chars=False):
+        self.may_pass = may_pass
+        self.normalize = normalize
+        self.good_chars = good_chars
+        self.leave_alphanum = leave_alphanum
+        self.min_length = min_length
+        self.length_in_chars = length_in_chars
+
+
+EN_GOOD_CHARS = re.compile(
+    r"^[A-Za-z0-9\,\.\-\?\"\'\’\!\“\s\;\:\“\”\–\‘\’\’\/\\]+$",
+    re.IGNORECASE)
+# Scripts normalize() never turns into allowed characters
+EN_FOREIGN_SCRIPT = re.compile(
+    '[\u0400-\u04ff\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]')
+# Only tags, speakers and bracketed text are removed by normalize()
+EN_REMOVABLE = re.compile(r'[<:\[(*]')
+
+
+def en_may_pass(text):
+    return EN_FOREIGN_SCRIPT.search(text) is None \
+        or EN_REMOVABLE.search(text) is not None
+
+
+ZH_DIGITS = '零一二三四五六七八九'
+ZH_POWERS = ((1000, '千'), (100, '百'), (10, '十'), (1, ''))
+
+
+def _zh_below_10000(num):
+    result = ''
+    zero = False
+    for power, unit in ZH_POWERS:
+        digit = num // power % 10
+        if digit == 0:
+            zero = bool(result)
+            continue
+        if zero:
+            result += '零'
+            zero = False
+        result += ZH_DIGITS[digit] + unit
+    return result
+
+
+def int_to_zh(num):
+    if num < 10000:
+        result = _zh_below_10000(num) or '零'
+    elif num < 100000000:
+        high, low = divmod(num, 10000)
+        result = _zh_below_10000(high) + '万'
+        if low:
+            result += ('零' if low < 1000 else '') + _zh_below_10000(low)
+    else:
+        return digits_to_zh(str(num))
+    # 十五 rather than 一十五
+    if result.startswith('一十'):
+        result = result[1:]
+    return result
+
+
+def digits_to_zh(digits):
+    return ''.join(ZH_DIGITS[int(d)] for d in digits)
+
+
+ZH_NUMBER = re.compile(r'(\d+)(?:\.(\d+))?(%)?')
+ZH_REMOVED = re.compile(r'<[^<]+?>|\[.*?\]|\(.*?\)|【.*?】|\*.*?\*')
+ZH_SPEAKER = re.compile(r'^\s*[^\s:]{1,8}:')
+ZH_PUNCTUATION = re.compile(r'[\W_]+')
+ZH_GOOD_CHARS = re.compile('^[\u3007\u3400-\u4dbf\u4e00-\u9fff ]+$')
+# Characters which are, or may become after normalization, Chinese
+# characters or numbers
+ZH_MAY_PASS = re.compile(
+    '[\\d\u2460-\u24ff\u2e80-\u2fdf\u3007\u3220-\u33ff\u3400-\u4dbf'
+    '\u4e00-\u9fff\uf900-\ufaff\U0001f200-\U0001f2ff]')
+
+
+def _zh_number(match):
+    integer, fraction, percent = match.groups()
+    if len(integer) > 1 and integer[0] == '0' \
+            or match.string.startswith('年', match.end()):
+        result = digits_to_zh(integer)
+    else:
+        result = int_to_zh(int(integer))
+    if fraction:
+        result += '点' + digits_to_zh(fraction)
+    if percent:
+        result = '百分之' + result
+    return result
+
+
+def zh_may_pass(text):
+    return ZH_MAY_PASS.search(text) is not None
+
+
+def zh_normalize(text):
+    text = unicodedata.normalize('NFKC', text)
+    text = ZH_REMOVED.sub(' ', text)
+    text = ZH_SPEAKER.sub(' ', text)
+    text = ZH_NUMBER.sub(_zh_number, text)
+    return ' '.join(ZH_PUNCTUATION.sub(' ', text).split())
+
+
+def zh_leave_alphanum(text):
+    return ' '.join(text.split())
+
+
+PROFILES = {
+    'en': Profile(en_may_pass, normalizer.normalize, EN_GOOD_CHARS,
+        normalizer.leave_alphanum, min_length=5),
+    'zh-CN': Profile(zh_may_pass, zh_normalize, ZH_GOOD_CHARS,
+        zh_leave_alphanum, min_length=5, length_in_chars=True),
+}
+
+
+def get_profile(lang):
+    try:
+        return PROFILES[lang]
+    except KeyError:
+        raise ValueError(f'No filter profile for language {lang!r}') from None
@@ -1,5 +1,6 @@
 # This file is mostly copied from https://github.com/EgorLakomkin/KTSpeechCrawler/blob/master/crawler/youtube_helpers.py
 
+import collections
 import hashlib
 import json
 import os
@@ -13,6 +14,8 @@ from path import Path
 import unicodedata
 
 from .utils import get_ts_seconds
+from .captions import CaptionColumns
+from .parsers import iter_captions
 
 everything_cool = re.compile(r"^[A-Za-z0-9\,\.\-\?\"\'\’\!\“\s\;\:\“\”\–\‘\’\’\/\\]+$", re.IGNORECASE)
 leave_chars = re.compile(r"[^a-z\s\']", re.IGNORECASE)
@@ -82,6 +85,10 @@ def load_all_subtitles(subtitle_file):
     return res
 
 
+def load_captions(subtitle_file):
+    return list(iter_captions(subtitle_file))
+
+
 def get_video_file(subtitle_file):
     naive_video_file = subtitle_file.replace(".en.vtt", ".mp4")
     webm_video_file = subtitle_file.replace(".en.vtt", ".webm")
@@ -122,6 +129,119 @@ def merge_subtitles(subs, min_dist=1.5, max_dist=6.0):
     return res
 
 
+def iter_merged_captions(subs, min_dist=1.5, max_dist=6.0):
+    """
+    Merge consecutive captions like merge_subtitles(), yielding each caption
+    once nothing more can be merged into it. Captions are merged in place:
+    the first caption of each merged run is extended.
+    """
+    min_dist_ms = min_dist * 1000
+    max_dist_ms = max_dist * 1000
+    prev_s = None
+    for s in subs:
+        if prev_s is not None:
+            distance = s.start_ms - prev_s.end_ms
+            assert distance >= 0
+            if distance < min_dist_ms and s.end_ms - prev_s.start_ms < max_dist_ms:
+                prev_s.end_ms = s.end_ms
+                prev_s.text += " " + s.text
+                continue
+            yield prev_s
+        prev_s = s
+    if prev_s is not None:
+        yield prev_s
+
+
+def merge_captions(subs, min_dist=1.5, max_dist=6.0):
+    """
+    merge_subtitles() for Caption objects, merging in place.
+    """
+    return list(iter_merged_captions(subs, min_dist, max_dist))
+
+
+def merge_caption_columns(columns, min_dist=1.5, max_dist=6.0):
+    """
+    merge_captions() for CaptionColumns.
+    """
+    min_dist_ms = min_dist * 1000
+    max_dist_ms = max_dist * 1000
+    res = CaptionColumns([], [], [], [])
+    for start, end, text, idx in zip(columns.start_ms, columns.end_ms,
+            columns.text, columns.idx):
+        if res.idx:
+            distance = start - res.end_ms[-1]
+            assert distance >= 0
+            if distance < min_dist_ms and end - res.start_ms[-1] < max_dist_ms:
+                res.end_ms[-1] = end
+                res.text[-1] += " " + text
+                continue
+        res.start_ms.append(start)
+        res.end_ms.append(end)
+        res.text.append(text)
+        res.idx.append(idx)
+    return res
+
+
+def find_overlapping_captions(start_ms, end_ms, width=3):
+    """
+    Return the indices of the captions overlapping with any of the `width`
+    captions before or after them, given the start and end columns.
+    Overlapping is symmetric, so each caption is only compared with the
+    `width` captions after it.
+    """
+    bad_indices = set([])
+    count = len(start_ms)
+    for s_idx in range(count):
+        s_start, s_end = start_ms[s_idx], end_ms[s_idx]
+        for j in range(s_idx + 1, min(s_idx + width + 1, count)):
+            if s_start < end_ms[j] < s_end or start_ms[j] < s_end < end_ms[j]:
+                bad_indices.add(s_idx)
+                bad_indices.add(j)
+    return bad_indices
+
+
+def iter_non_overlapping_captions(subs, width=3):
+    """
+    Yield the captions not overlapping with any of the `width` captions
+    before or after them, like remove_overlapping_subtitles(). Each caption
+    is compared with the ones before it as it arrives, so only the last
+    `width` captions are held back.
+    """
+    window = collections.deque()
+    for s in subs:
+        entry = [s, False]
+        for prev in window:
+            prev_s = prev[0]
+            if s.start_ms < prev_s.end_ms < s.end_ms \
+                    or prev_s.start_ms < s.end_ms < prev_s.end_ms:
+                prev[1] = True
+                entry[1] = True
+        window.append(entry)
+        if len(window) > width:
+            prev_s, bad = window.popleft()
+            if not bad:
+                yield prev_s
+    for prev_s, bad in window:
+        if not bad:
+            yield prev_s
+
+
+def remove_overlapping_captions(subs, width=3):
+    """
+    remove_overlapping_subtitles() for Caption objects.
+    """
+    return list(iter_non_overlapping_captions(subs, width))
+
+
+def clean_captions(subs, width=3, min_dist=1.5, max_dist=6.0):
+    """
+    remove_overlapping_captions() followed by merge_captions(), in a single
+    pass over the captions.
+    """
+    return list(iter_merged_captions(
+        iter_non_overlapping_captions(subs, width), min_dist, max_dist))
+
+
 def check_sub_overlap(sub1, sub2):
     sub1_start, sub1_end = sub1["ts_start"], sub1["ts_end"]
     sub2_start, sub2_end = sub2["ts_start"], sub2["ts_end"]
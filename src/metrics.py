@@ -0,0 +1,183 @@
+"""
+Counters and timers for the crawler and the processing steps, exported
+in the Prometheus text format to a file or over HTTP, and per-video
+events logged as JSON lines.
+"""
+
+import contextlib
+import http.server
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+
+PREFIX = 'speech_crawler_'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"')
+        .replace('\n', r'\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"'
+        for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Metrics:
+    """
+    Counters, and timers keeping the count and sum of observed durations.
+    Metrics are identified by name and labels. Safe to use from several
+    threads; snapshot() and merge() move metrics between processes.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__timers = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            count, total = self.__timers.get(key, (0, 0.0))
+            self.__timers[key] = (count + 1, total + seconds)
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self.__lock:
+            return dict(self.__counters), dict(self.__timers)
+
+    def merge(self, snapshot):
+        counters, timers = snapshot
+        with self.__lock:
+            for key, value in counters.items():
+                self.__counters[key] = self.__counters.get(key, 0) + value
+            for key, (count, total) in timers.items():
+                old_count, old_total = self.__timers.get(key, (0, 0.0))
+                self.__timers[key] = (old_count + count, old_total + total)
+
+    def render(self):
+        counters, timers = self.snapshot()
+        lines = []
+        for kind, metrics in (('counter', counters), ('summary', timers)):
+            last_name = None
+            for (name, labels), value in sorted(metrics.items()):
+                name = PREFIX + name
+                if name != last_name:
+                    lines.append(f'# TYPE {name} {kind}')
+                    last_name = name
+                labels = _format_labels(labels)
+                if kind == 'counter':
+                    lines.append(f'{name}{labels} {value}')
+                else:
+                    lines.append(f'{name}_count{labels} {value[0]}')
+                    lines.append(f'{name}_sum{labels} {value[1]:.6f}')
+        return ''.join(line + '\n' for line in lines)
+
+    def write(self, filename):
+        temp = f'{filename}.{os.getpid()}.tmp'
+        with open(temp, 'w') as f:
+            f.write(self.render())
+        os.replace(temp, filename)
+
+
+REGISTRY = Metrics()
+
+
+@contextlib.contextmanager
+def timed(phases, name):
+    """
+    Add the time spent in the block to phases[name].
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
+
+
+def log_event(event, **fields):
+    logging.getLogger('metrics').info('%s',
+        json.dumps({'event': event, **fields}, sort_keys=True))
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        data = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class Exporter:
+    """
+    Serve `metrics` over HTTP on `port`, and/or write them to `filename`
+    every `interval` seconds and on close().
+    """
+    def __init__(self, metrics, filename=None, port=None, interval=15):
+        self.__metrics = metrics
+        self.__filename = filename
+        self.__interval = interval
+        self.__stop = threading.Event()
+        self.__threads = []
+        self.__server = None
+        if port is not None:
+            self.__server = MetricsServer(('', port), MetricsHandler)
+            self.__server.metrics = metrics
+            self.__start(self.__server.serve_forever)
+        if filename is not None:
+            self.__start(self.__write_periodically)
+
+    def close(self):
+        self.__stop.set()
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+        for thread in self.__threads:
+            thread.join()
+        if self.__filename is not None:
+            self.__metrics.write(self.__filename)
+
+    def __start(self, target):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        self.__threads.append(thread)
+
+    def __write_periodically(self):
+        while not self.__stop.wait(self.__interval):
+            self.__metrics.write(self.__filename)
+
+
+def add_metrics_options(p, server=True):
+    p.add_argument('--metrics-file',
+        help='Write metrics in the Prometheus text format to this file.')
+    if server:
+        p.add_argument('--metrics-port', type=int,
+            help='Serve metrics in the Prometheus text format over HTTP on '
+                'this port.')
+
+
+def start_exporter(cmdline, metrics=REGISTRY):
+    return Exporter(metrics, cmdline.metrics_file,
+        getattr(cmdline, 'metrics_port', None))
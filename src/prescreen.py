@@ -0,0 +1,98 @@
+import io
+import logging
+import queue
+import urllib.request
+
+from youtube_dl.utils import locked_file
+
+import dal
+import filter
+import metrics
+from filter.parsers import iter_ttml_captions, iter_vtt_captions
+
+
+def parse_subtitles(data, ext):
+    if ext in ('ttml', 'xml'):
+        return iter_ttml_captions(io.BytesIO(data.encode('utf-8')))
+    return iter_vtt_captions(io.StringIO(data))
+
+
+class SubtitlePreScreen:
+    """
+    A youtube_dl match_filter, run after the video page has been extracted
+    but before anything is downloaded. It fetches the subtitles and runs
+    them through the filter pipeline, and the audio is only downloaded if
+    at least `min_speech_seconds` of captions pass.
+
+    Rejected videos are added to the download archive, so they are not
+    screened again, and queued for record(). The filter is called from the
+    download threads, while record() must be called from the thread that
+    owns the database.
+    """
+    def __init__(self, lang, min_speech_seconds=0.0, archive=None,
+            timeout=10, urlopen=urllib.request.urlopen):
+        self.__lang = lang
+        self.__min_speech_ms = min_speech_seconds * 1000
+        self.__archive = archive
+        self.__timeout = timeout
+        self.__urlopen = urlopen
+        self.__rejected = queue.Queue()
+
+    def __call__(self, info):
+        subtitles = (info.get('requested_subtitles') or {}).get(self.__lang)
+        if subtitles is None:
+            return self.__reject(info, dal.DataAccessLayer.STATUS_SUBS_MISSING,
+                'no subtitles')
+
+        data = subtitles.get('data')
+        if data is None:
+            try:
+                with self.__urlopen(subtitles['url'],
+                        timeout=self.__timeout) as response:
+                    data = response.read().decode('utf-8')
+            except (OSError, ValueError):
+                logging.warning('Cannot pre-screen subtitles of %s',
+                    info['id'], exc_info=True)
+                return None
+            # Saves youtube_dl from downloading them again
+            subtitles['data'] = data
+
+        try:
+            captions = filter.filter_captions(
+                parse_subtitles(data, subtitles['ext']),
+                self.__lang)
+        except (ValueError, SyntaxError):
+            captions = []
+        speech_ms = sum(c.duration_ms for c in captions)
+        if not captions or speech_ms < self.__min_speech_ms:
+            return self.__reject(info, dal.DataAccessLayer.STATUS_INVALID_SUBS,
+                f'{speech_ms / 1000:.1f}s of usable subtitles')
+        metrics.REGISTRY.inc('prescreen_accepted_total')
+        return None
+
+    def record(self, database: dal.DataAccessLayer):
+        """
+        Set the status of the videos rejected so far in `database`, and add
+        them to the subtitle yield of their channels.
+        """
+        while True:
+            try:
+                video_id, channel_id, status, checked_ms = \
+                    self.__rejected.get_nowait()
+            except queue.Empty:
+                return
+            with database.transaction():
+                added = database.add_video(video_id, channel_id)
+                database.set_video_status(video_id, status)
+                if added and channel_id is not None:
+                    database.add_channel_sample(channel_id, checked_ms, 0,
+                        False)
+
+    def __reject(self, info, status, reason):
+        metrics.REGISTRY.inc('prescreen_rejected_total', status=status)
+        self.__rejected.put((info['id'], info.get('channel_id'), status,
+            int((info.get('duration') or 0) * 1000)))
+        if self.__archive is not None:
+            with locked_file(self.__archive, 'a', encoding='utf-8') as f:
+                f.write(f"{info['extractor_key'].lower()} {info['id']}\n")
+        return f'Skipping {info["id"]}, pre-screen rejected it: {reason}'
@@ -1,25 +1,36 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
 import os.path
 import logging
 import wave
 import sys
 import datetime
-import io
-
-import requests
+import json
+import mmap
+import struct
+import subprocess
+import tempfile
 
 import filter
 import dal
+import corpus
+import metrics
+from aligner import AlignerClient, AlignmentCache
 
 
 class AudioData:
+    """
+    16 kHz 16-bit mono PCM samples. The samples are accessed through a
+    memoryview, so `data` can be bytes, a bytearray or an mmap, and
+    exported segments are views into it rather than copies.
+    """
     SAMPLE_RATE = 16
     SAMPLE_SIZE = 2
 
-    def __init__(self, data: bytes):
-        self.__wave_bytes = data
+    def __init__(self, data):
+        self.__wave_bytes = memoryview(data).cast('B')
 
     def get_duration_ms(self):
         return len(self.__wave_bytes) // self.SAMPLE_SIZE // self.SAMPLE_RATE
@@ -36,13 +47,22 @@ class AudioData:
         if output_file is None:
             return content
 
-        wave_file = wave.open(output_file, 'wb')
-        wave_file.setnchannels(1)
-        wave_file.setnframes((end_offset - start_offset) // 2)
-        wave_file.setsampwidth(self.SAMPLE_SIZE)
-        wave_file.setframerate(self.SAMPLE_RATE * 1000)
-        wave_file.writeframes(content)
-        wave_file.close()
+        output_file.write(self.wav_header(len(content)))
+        output_file.write(content)
+
+    def export_wav(self, start, end):
+        """
+        Return the segment as the bytes of a WAV file, copying the samples
+        only once.
+        """
+        content = self.export(start, end)
+        return self.wav_header(len(content)) + content
+
+    def wav_header(self, data_size):
+        rate = self.SAMPLE_RATE * 1000
+        return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size,
+            b'WAVE', b'fmt ', 16, 1, 1, rate, rate * self.SAMPLE_SIZE,
+            self.SAMPLE_SIZE, self.SAMPLE_SIZE * 8, b'data', data_size)
 
     def __timestamp_to_offset(self, milliseconds):
         sample_offset = milliseconds * self.SAMPLE_RATE
@@ -52,19 +72,116 @@ class AudioData:
         return byte_offset
 
 
+def map_wav_file(filename):
+    """
+    Memory map the samples of a 16 kHz 16-bit mono WAV file, returning a
+    read only memoryview of them.
+    """
+    with wave.open(filename, 'rb') as audio_file:
+        assert audio_file.getnchannels() == 1
+        assert audio_file.getsampwidth() == AudioData.SAMPLE_SIZE
+        assert audio_file.getframerate() == AudioData.SAMPLE_RATE * 1000
+        data_size = audio_file.getnframes() * AudioData.SAMPLE_SIZE
+
+    with open(filename, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    offset = 12
+    while offset + 8 <= len(mapped):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', mapped, offset)
+        offset += 8
+        if chunk_id == b'data':
+            return memoryview(mapped)[offset:offset + data_size]
+        offset += chunk_size + (chunk_size & 1)
+    raise RuntimeError("No data chunk in WAV file %s" % filename)
+
+
 def get_ms(ts: datetime.time):
     return ts.hour * 3600 * 1000 + ts.minute * 60 * 1000 + ts.second * 1000 \
         + ts.microsecond // 1000
 
 
-def parse_cmdline():
-    p = argparse.ArgumentParser()
-    p.add_argument('--lang', required=True)
-    p.add_argument('--dest', required=True)
-    p.add_argument('--ffmpeg', default='ffmpeg')
+def add_processing_options(p, default_lang=None):
+    p.add_argument('--lang', required=default_lang is None,
+        default=default_lang, choices=sorted(filter.PROFILES),
+        help='Subtitle language.')
+    p.add_argument('--dest', required=True, help='Directory to save stuff')
+    p.add_argument('--ffmpeg', default='ffmpeg', help='ffmpeg path.')
     p.add_argument('--alignment-service', default='http://localhost:8765')
-    p.add_argument('--forced-align', action='store_true')
+    p.add_argument('--forced-align', action='store_true',
+        help='Run "forced alignment" post processing step.')
+    p.add_argument('--align-window', type=float, default=0,
+        help='Align runs of subtitles spanning up to this many seconds in '
+            'one request, instead of one request per subtitle.')
+    p.add_argument('--aligner-concurrency', type=int, default=4,
+        help='Number of concurrent requests to the alignment service.')
+    p.add_argument('--aligner-timeout', type=float, default=60,
+        help='Seconds to wait for an alignment response.')
+    p.add_argument('--aligner-retries', type=int, default=3,
+        help='Number of times a failed alignment request is retried.')
+    p.add_argument('--aligner-version', default='gentle',
+        help='Version of the alignment service, part of the cache key.')
+    p.add_argument('--align-cache-size', type=int, default=0,
+        help='Cache alignment results in DEST/align_cache.sqlite3, up to '
+            'this many MiB.')
     p.add_argument('--fix-data', action='store_true')
+    p.add_argument('--stream-decode', action='store_true',
+        help='Pipe decoded audio from ffmpeg into memory instead of writing '
+            'and reading back a WAV file under DEST/wav/.')
+    p.add_argument('--export-clips', action='store_true',
+        help='Also write the audio and transcript of every accepted '
+            'utterance into tar shards under DEST/corpus/. Implies '
+            '--stream-decode.')
+    p.add_argument('--shard-size', type=int, default=1024,
+        help='Size of a clip shard in MiB.')
+    p.add_argument('--mmap-threshold', type=int, default=256,
+        help='With --stream-decode, keep decoded audio larger than this many '
+            'MiB in a memory mapped temporary file.')
+    add_database_options(p)
+
+
+def add_database_options(p):
+    p.add_argument('--db-concurrent', action='store_true',
+        help='Use WAL journaling and wait for locks, for databases written '
+            'by many processes on one host at the same time.')
+    p.add_argument('--db-mmap-size', type=int,
+        help='Number of bytes of the database to access through mmap.')
+
+
+def open_database(cmdline):
+    return dal.DataAccessLayer(f'{cmdline.dest}/db.sqlite3',
+        concurrent=cmdline.db_concurrent, mmap_size=cmdline.db_mmap_size)
+
+
+def open_aligner(cmdline):
+    if not cmdline.forced_align:
+        return None
+    cache = None
+    if cmdline.align_cache_size > 0:
+        cache = AlignmentCache(f'{cmdline.dest}/align_cache.sqlite3',
+            cmdline.align_cache_size * 1024 * 1024)
+    return AlignerClient(cmdline.alignment_service,
+        concurrency=cmdline.aligner_concurrency,
+        timeout=cmdline.aligner_timeout, retries=cmdline.aligner_retries,
+        cache=cache, version=cmdline.aligner_version)
+
+
+def open_clip_writer(cmdline):
+    if not cmdline.export_clips:
+        return None
+    return corpus.ShardWriter(f'{cmdline.dest}/corpus',
+        cmdline.shard_size * 1024 * 1024)
+
+
+def parse_processing_options(args):
+    p = argparse.ArgumentParser()
+    add_processing_options(p)
+    return p.parse_args(args)
+
+
+def parse_cmdline():
+    p = argparse.ArgumentParser()
+    add_processing_options(p)
+    metrics.add_metrics_options(p, server=False)
     p.add_argument('video_file')
     return p.parse_args()
 
@@ -81,7 +198,9 @@ def mark_subtitles_invalid(video_id, video_file, database: dal.DataAccessLayer):
 
 def adjust_subtitle(sub, alignment, audio_start):
     correct = 0
-    words = alignment['words']
+    words = alignment.get('words')
+    if not words:
+        return False
     for word in words:
         if word['case'] == 'success':
             correct += 1
@@ -97,47 +216,125 @@ def adjust_subtitle(sub, alignment, audio_start):
     actual_start = int(words[0]['start'] * 1000) + audio_start - 10
     actual_end = int(words[-1]['end'] * 1000) + audio_start + 10
 
-    sub['ts_start'] = actual_start
-    sub['ts_end'] = actual_end
+    sub.start_ms = actual_start
+    sub.end_ms = actual_end
 
     return True
 
 
-def force_align_subtitles(subtitles, aligner, audio_data: AudioData):
-    for i, sub in enumerate(subtitles['subtitles']):
-        start = get_ms(sub['ts_start'])
-        start -= 1000
-        if start < 0:
-            start = 0
-        end = get_ms(sub['ts_end'])
-        end += 1000
-        with io.BytesIO() as f:
-            audio_data.export(start, end, output_file=f)
-            wav_data = f.getvalue()
-            post_files = {
-                'audio': ('audio.wav', wav_data, 'audio/wav'),
-                'transcript': ('transcript.txt', sub['original_phrase'])
-            }
-        response = requests.post(aligner + '/transcriptions?async=false',
-                files=post_files)
-        alignment = response.json()
-        adjust_subtitle(sub, alignment, start)
-
-    return False
+def get_alignment_window(sub):
+    start = sub.start_ms
+    start -= 1000
+    if start < 0:
+        start = 0
+    end = sub.end_ms
+    end += 1000
+    return start, end
+
+
+def check_alignments(alignments, stats: metrics.Metrics):
+    """
+    Count the alignments the service failed to return in `stats`. If it
+    failed all of them, raise so the video is retried later instead of
+    being marked as having invalid subtitles.
+    """
+    failures = alignments.count(None)
+    if failures > 0:
+        stats.inc('alignment_failures_total', failures)
+        if failures == len(alignments):
+            raise RuntimeError('Alignment service failed every request')
+
+
+def force_align_subtitles(subtitles, aligner: AlignerClient,
+        audio_data: AudioData, stats: metrics.Metrics = metrics.REGISTRY):
+    """
+    Align every subtitle against its audio and keep the ones that aligned
+    well. Subtitles the service failed to align are dropped. Return whether
+    any subtitles are left.
+    """
+    def jobs():
+        for sub in subtitles['subtitles']:
+            start, end = get_alignment_window(sub)
+            yield audio_data.export_wav(start, end), sub.text
+
+    aligned = []
+    alignments = list(aligner.align_many(jobs()))
+    check_alignments(alignments, stats)
+    for sub, alignment in zip(subtitles['subtitles'], alignments):
+        start, _ = get_alignment_window(sub)
+        if alignment is not None and adjust_subtitle(sub, alignment, start):
+            aligned.append(sub)
+    subtitles['subtitles'] = aligned
+
+    return len(aligned) > 0
+
+
+def split_alignment_windows(subs, window_ms):
+    window = []
+    for sub in subs:
+        if window and sub.end_ms - window[0].start_ms > window_ms:
+            yield window
+            window = []
+        window.append(sub)
+    if window:
+        yield window
+
+
+def force_align_windows(subtitles, aligner: AlignerClient,
+        audio_data: AudioData, window_ms,
+        stats: metrics.Metrics = metrics.REGISTRY):
+    """
+    Like force_align_subtitles(), but align runs of subtitles spanning up to
+    `window_ms` in one request each, then split the aligned words back into
+    subtitles by their character offsets in the joined transcript.
+    """
+    windows = list(split_alignment_windows(subtitles['subtitles'], window_ms))
+
+    def jobs():
+        for window in windows:
+            start, _ = get_alignment_window(window[0])
+            _, end = get_alignment_window(window[-1])
+            transcript = ' '.join(sub.text for sub in window)
+            yield audio_data.export_wav(start, end), transcript
+
+    aligned = []
+    alignments = list(aligner.align_many(jobs()))
+    check_alignments(alignments, stats)
+    for window, alignment in zip(windows, alignments):
+        if alignment is None:
+            continue
+        start, _ = get_alignment_window(window[0])
+        offsets = []
+        offset = 0
+        for sub in window:
+            offsets.append(offset)
+            offset += len(sub.text) + 1
+        words = [[] for _ in window]
+        for word in alignment.get('words', []):
+            words[bisect.bisect_right(offsets, word['startOffset']) - 1] \
+                .append(word)
+        for sub, sub_words in zip(window, words):
+            if adjust_subtitle(sub, {'words': sub_words}, start):
+                aligned.append(sub)
+    subtitles['subtitles'] = aligned
+
+    return len(aligned) > 0
 
 
 def export_subtitles(video_id, subtitles, database: dal.DataAccessLayer):
+    rows = []
     for sub in subtitles['subtitles']:
-        if isinstance(sub['ts_start'], datetime.time):
-            start = get_ms(sub['ts_start'])
-        else:
-            start = sub['ts_start']
-        if isinstance(sub['ts_end'], datetime.time):
-            end = get_ms(sub['ts_end'])
-        else:
-            end = sub['ts_end']
-        database.add_subtitle(video_id, sub['original_phrase'].lower(),
-            start, end)
+        rows.append((sub.text.lower(), sub.start_ms, sub.end_ms))
+    database.add_subtitles_bulk(video_id, rows)
+
+
+def export_clips(video_id, subtitles, audio_data: AudioData,
+        clips: corpus.ShardWriter):
+    for i, sub in enumerate(subtitles['subtitles']):
+        samples = audio_data.export(sub.start_ms, sub.end_ms)
+        clips.add(f'{video_id}-{i:05d}', audio_data.wav_header(len(samples)),
+            samples, sub.text.lower(), {'video_id': video_id,
+                'start_time': sub.start_ms, 'end_time': sub.end_ms})
 
 
 def load_video_file(ffmpeg, filename, dest):
@@ -154,18 +351,70 @@ def load_video_file(ffmpeg, filename, dest):
     if status != 0:
         raise RuntimeError("Failed to convert video file %s" % filename)
 
-    audio_file = wave.open(target_path, 'rb')
-    frame_count = audio_file.getnframes()
-    data = audio_file.readframes(frame_count)
-    assert len(data) == frame_count * 2
+    return map_wav_file(target_path), target_path
+
+
+def get_duration(video_file):
+    info_file = video_file[:-3] + 'info.json'
+    try:
+        with open(info_file) as f:
+            return json.load(f).get('duration')
+    except (OSError, ValueError):
+        return None
+
+
+def decode_video_file(ffmpeg, filename, dest, duration=None,
+        mmap_threshold=256 * 1024 * 1024):
+    """
+    Decode a video file into 16 kHz mono PCM through a pipe. The samples
+    are read straight into a buffer preallocated from the expected
+    duration (in seconds), which is backed by a temporary file under
+    dest/wav/ if it is larger than `mmap_threshold` bytes.
+    """
+    bytes_per_second = AudioData.SAMPLE_RATE * 1000 * AudioData.SAMPLE_SIZE
+    size = (int(duration or 0) + 1) * bytes_per_second
+    if size > mmap_threshold:
+        os.makedirs(dest + '/wav/', exist_ok=True)
+        with tempfile.TemporaryFile(dir=dest + '/wav/') as backing:
+            backing.truncate(size)
+            buffer = mmap.mmap(backing.fileno(), size)
+    else:
+        buffer = bytearray(size)
+
+    child = subprocess.Popen([ffmpeg, '-nostdin', '-i', filename,
+        '-ac', '1', '-ar', '16000', '-f', 's16le', '-acodec', 'pcm_s16le',
+        '-'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    length = 0
+    with child.stdout:
+        while True:
+            if length == len(buffer):
+                size = len(buffer) + max(len(buffer) // 2, bytes_per_second)
+                if isinstance(buffer, mmap.mmap):
+                    buffer.resize(size)
+                else:
+                    buffer.extend(bytes(size - len(buffer)))
+            with memoryview(buffer) as view:
+                count = child.stdout.readinto(view[length:])
+            if not count:
+                break
+            length += count
+    if child.wait() != 0 or length == 0:
+        raise RuntimeError("Failed to convert video file %s" % filename)
 
-    return data, target_path
+    if isinstance(buffer, mmap.mmap):
+        buffer.resize(length)
+    else:
+        del buffer[length:]
+    return buffer
 
 
-def get_id(video_path, dest):
-    name = video_path[len(dest) + 1:]
-    channel_id = os.path.dirname(name)
-    basename = os.path.basename(name)
+def get_id(video_path):
+    """
+    The video and channel ID of a file downloaded to
+    .../CHANNEL_ID/VIDEO_ID#TITLE.m4a
+    """
+    channel_id = os.path.basename(os.path.dirname(video_path))
+    basename = os.path.basename(video_path)
     sharp = basename.find('#')
     assert sharp > 0
     video_id = basename[:sharp]
@@ -173,45 +422,123 @@ def get_id(video_path, dest):
     return video_id, channel_id
 
 
-def main():
-    logging.basicConfig(level=logging.INFO)
-    cmdline = parse_cmdline()
-    assert cmdline.video_file.endswith('.m4a')
-
-    database = dal.DataAccessLayer(f'{cmdline.dest}/db.sqlite3')
-    video_id, channel_id = get_id(cmdline.video_file, cmdline.dest)
-    if not database.add_video(video_id, channel_id):
-        if not cmdline.fix_data:
-            return
-
-    subtitles_file = cmdline.video_file[:-3] + f'{cmdline.lang}.vtt'
+def filter_observer(stats: metrics.Metrics):
+    def observe(name, seconds, captions_in, captions_out):
+        stats.observe('filter_seconds', seconds, filter=name)
+        stats.inc('filter_captions_in_total', captions_in, filter=name)
+        stats.inc('filter_captions_out_total', captions_out, filter=name)
+    return observe
+
+
+def process_video(cmdline, video_file, database: dal.DataAccessLayer,
+        clips: corpus.ShardWriter = None, aligner: AlignerClient = None,
+        stats: metrics.Metrics = metrics.REGISTRY):
+    """
+    Process a downloaded video and return the outcome. The time spent in
+    each phase and the statistics of every filter are added to `stats`,
+    and logged as one JSON line per video. Unless the video was processed
+    before, its subtitle yield is added to its channel.
+    """
+    record = {'phases': {}}
+    outcome = 'error'
+    try:
+        outcome = _process_video(cmdline, video_file, database, clips,
+            aligner, stats, record)
+        if 'channel_id' in record:
+            with metrics.timed(record['phases'], 'db'):
+                database.add_channel_sample(record['channel_id'],
+                    record['checked_ms'], record.get('speech_ms', 0),
+                    outcome == 'done')
+        return outcome
+    finally:
+        stats.inc('videos_total', outcome=outcome)
+        for phase, seconds in record['phases'].items():
+            stats.observe('phase_seconds', seconds, phase=phase)
+        metrics.log_event('video', video_file=video_file, outcome=outcome,
+            **record)
+
+
+def _process_video(cmdline, video_file, database, clips, aligner, stats,
+        record):
+    assert video_file.endswith('.m4a')
+    phases = record['phases']
+
+    video_id, channel_id = get_id(video_file)
+    if database.add_video(video_id, channel_id):
+        record['channel_id'] = channel_id
+        record['checked_ms'] = int((get_duration(video_file) or 0) * 1000)
+    elif not cmdline.fix_data:
+        return 'duplicate'
+
+    subtitles_file = video_file[:-3] + f'{cmdline.lang}.vtt'
     if not os.path.isfile(subtitles_file):
-        mark_subtitles_missing(video_id, cmdline.video_file, database)
-        return
+        mark_subtitles_missing(video_id, video_file, database)
+        return 'subtitles_missing'
+
+    with metrics.timed(phases, 'filter'):
+        subtitles = filter.load_and_filter(subtitles_file, compact=True,
+            lang=cmdline.lang, observe=filter_observer(stats))
+    if len(subtitles['subtitles']) == 0:
+        mark_subtitles_invalid(video_id, video_file, database)
+        return 'subtitles_invalid'
+
+    with metrics.timed(phases, 'decode'):
+        # Clips are cut from the decoded audio, a WAV copy isn't needed.
+        if cmdline.stream_decode or cmdline.export_clips:
+            raw_audio = decode_video_file(cmdline.ffmpeg, video_file,
+                cmdline.dest, get_duration(video_file),
+                cmdline.mmap_threshold * 1024 * 1024)
+        else:
+            raw_audio, wav_path = \
+                load_video_file(cmdline.ffmpeg, video_file, f'{cmdline.dest}')
+        audio_data = AudioData(raw_audio)
+    record['checked_ms'] = audio_data.get_duration_ms()
 
-    subtitles = filter.load_and_filter(subtitles_file)
-    if len(subtitles) == 0:
-        mark_subtitles_invalid(video_id, cmdline.video_file, database)
-        return
+    if cmdline.forced_align:
+        with metrics.timed(phases, 'align'):
+            if cmdline.align_window > 0:
+                success = force_align_windows(subtitles, aligner, audio_data,
+                    int(cmdline.align_window * 1000), stats)
+            else:
+                success = force_align_subtitles(subtitles, aligner,
+                    audio_data, stats)
+        if not success:
+            mark_subtitles_invalid(video_id, video_file, database)
+            return 'alignment_failed'
+
+    record['captions'] = len(subtitles['subtitles'])
+    record['speech_ms'] = sum(sub.end_ms - sub.start_ms
+        for sub in subtitles['subtitles'])
+    with metrics.timed(phases, 'db'):
+        with database.transaction():
+            database.set_video_length(video_id, audio_data.get_duration_ms())
+            export_subtitles(video_id, subtitles, database)
+    if clips is not None:
+        with metrics.timed(phases, 'clips'):
+            export_clips(video_id, subtitles, audio_data, clips)
+    return 'done'
 
-    raw_audio, wav_path = \
-        load_video_file(cmdline.ffmpeg, cmdline.video_file, f'{cmdline.dest}')
-    audio_data = AudioData(raw_audio)
 
-    if cmdline.forced_align:
-        if not force_align_subtitles(subtitles, cmdline.alignment_service,
-                audio_data):
-            mark_subtitles_invalid(video_id, cmdline.video_file, database)
-            return
+def main():
+    logging.basicConfig(level=logging.INFO)
+    cmdline = parse_cmdline()
 
-    database.set_video_length(video_id, audio_data.get_duration_ms())
-    export_subtitles(video_id, subtitles, database)
+    database = open_database(cmdline)
+    clips = open_clip_writer(cmdline)
+    aligner = open_aligner(cmdline)
+    try:
+        process_video(cmdline, cmdline.video_file, database, clips, aligner)
+    finally:
+        if clips is not None:
+            clips.close()
+        if aligner is not None:
+            aligner.close()
+        if cmdline.metrics_file:
+            metrics.REGISTRY.write(cmdline.metrics_file)
 
 
 def test_export():
-    wave_file = wave.open(sys.argv[1], 'rb')
-    content = wave_file.readframes(wave_file.getnframes())
-    audio = AudioData(content)
+    audio = AudioData(map_wav_file(sys.argv[1]))
     data = audio.export(int(1000 * float(sys.argv[2])), int(1000 * float(sys.argv[3])))
     with open(sys.argv[4], 'wb') as f:
         f.write(data)
@@ -0,0 +1,144 @@
+import concurrent.futures
+import contextlib
+import logging
+import queue
+import threading
+import time
+import urllib.parse
+
+import metrics
+
+
+class RateLimiter:
+    """
+    Space out requests to the same host by at least `interval` seconds.
+    """
+    def __init__(self, interval):
+        self.__interval = interval
+        self.__lock = threading.Lock()
+        self.__next_time = {}
+
+    def wait(self, url):
+        if self.__interval <= 0:
+            return
+        host = urllib.parse.urlsplit(url).hostname
+        with self.__lock:
+            now = time.monotonic()
+            start = max(now, self.__next_time.get(host, now))
+            self.__next_time[host] = start + self.__interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class InstancePool:
+    """
+    A pool of reusable downloader instances, e.g. youtube_dl.YoutubeDL.
+    Instances are created on demand by `factory`, and each one is used by
+    at most one thread at a time.
+    """
+    def __init__(self, factory):
+        self.__factory = factory
+        self.__idle = queue.Queue()
+        self.__all = []
+        self.__lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def get(self):
+        try:
+            instance = self.__idle.get_nowait()
+        except queue.Empty:
+            instance = self.__factory()
+            with self.__lock:
+                self.__all.append(instance)
+        try:
+            yield instance
+        finally:
+            self.__idle.put(instance)
+
+    def close(self):
+        with self.__lock:
+            for instance in self.__all:
+                instance.__exit__(None, None, None)
+            self.__all = []
+
+
+class DownloadScheduler:
+    """
+    Keep up to `num_workers` downloads in flight. Jobs may finish out of
+    order, completion callbacks are always run in the calling thread.
+    """
+    def __init__(self, num_workers, pool: InstancePool, limiter: RateLimiter):
+        self.__num_workers = num_workers
+        self.__pool = pool
+        self.__limiter = limiter
+        self.__executor = concurrent.futures.ThreadPoolExecutor(num_workers)
+
+    def run(self, jobs, on_done, on_error=None):
+        """
+        Download every (job, url) pair from `jobs` and call on_done(job)
+        for each of them once its download finishes. A job may come with a
+        dict of downloader options for its download only, as a third item.
+        A job whose download raises is logged and passed to on_error(job)
+        instead, if given, without stopping the other downloads.
+        """
+        self.__run(self.__download, jobs, lambda job, _: on_done(job),
+            on_error)
+
+    def extract(self, jobs, on_done, on_error=None):
+        """
+        Like run(), but only extract the info dict of every URL, without
+        downloading anything, and call on_done(job, info) with it. info is
+        None if the downloader reported an error.
+        """
+        self.__run(self.__extract, jobs, on_done, on_error)
+
+    def close(self):
+        self.__executor.shutdown()
+        self.__pool.close()
+
+    def __run(self, function, jobs, on_done, on_error):
+        pending = {}
+        for job, url, *params in jobs:
+            if len(pending) >= self.__num_workers:
+                self.__wait(pending, on_done, on_error,
+                    concurrent.futures.FIRST_COMPLETED)
+            pending[self.__executor.submit(self.__call, function, url,
+                *params)] = job
+        self.__wait(pending, on_done, on_error,
+            concurrent.futures.ALL_COMPLETED)
+
+    def __call(self, function, url, params=None):
+        self.__limiter.wait(url)
+        logging.debug('Downloading %s', url)
+        with self.__pool.get() as downloader, \
+                metrics.REGISTRY.time('download_seconds'):
+            if not params:
+                return function(downloader, url)
+            saved = {key: downloader.params.get(key) for key in params}
+            downloader.params.update(params)
+            try:
+                return function(downloader, url)
+            finally:
+                downloader.params.update(saved)
+
+    @staticmethod
+    def __download(downloader, url):
+        downloader.download([url])
+
+    @staticmethod
+    def __extract(downloader, url):
+        return downloader.extract_info(url, download=False)
+
+    @staticmethod
+    def __wait(pending, on_done, on_error, return_when):
+        done, _ = concurrent.futures.wait(pending, return_when=return_when)
+        for future in done:
+            job = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception:
+                logging.exception('Failed to download job %s', job)
+                if on_error is not None:
+                    on_error(job)
+                continue
+            on_done(job, result)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import functools
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import signal
+import socket
+import socketserver
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+import process
+
+
+# Per worker process state, set up once by init_worker() so that imports,
+# compiled regexes and the database connection are reused across videos.
+_cmdline = None
+_database = None
+_clips = None
+_aligner = None
+
+
+def init_worker(cmdline):
+    global _cmdline, _database, _clips, _aligner
+    _cmdline = cmdline
+    _database = process.open_database(cmdline)
+    _aligner = process.open_aligner(cmdline)
+    _clips = process.open_clip_writer(cmdline)
+    if _clips is not None:
+        # Complete the last shard when the pool shuts the worker down.
+        multiprocessing.util.Finalize(_clips, _clips.close, exitpriority=10)
+
+
+def process_one(cmdline, video_file):
+    """
+    Process a video in a worker process, returning a snapshot of its
+    metrics for the parent process to merge. The worker is set up by
+    init_worker() on its first video.
+    """
+    if _cmdline is None:
+        init_worker(cmdline)
+    stats = metrics.Metrics()
+    try:
+        process.process_video(_cmdline, video_file, _database, _clips,
+            _aligner, stats)
+    except Exception:
+        logging.exception('Failed to process video file: %s', video_file)
+    return stats.snapshot()
+
+
+class ProcessingStage:
+    """
+    Process videos in a pool of worker processes, keeping at most
+    max_pending videos in flight. submit() blocks while the stage is full,
+    so that producers slow down to the speed of processing. Metrics of
+    the processed videos are merged into metrics.REGISTRY.
+
+    A worker dying, e.g. killed for running out of memory, fails the videos
+    in flight instead of losing them, and the pool is started again.
+    """
+    def __init__(self, cmdline, num_workers, max_pending):
+        # Create or upgrade the database once, before the workers start.
+        process.open_database(cmdline)
+        self.__cmdline = cmdline
+        self.__num_workers = num_workers
+        self.__lock = threading.Lock()
+        self.__executor = concurrent.futures.ProcessPoolExecutor(num_workers)
+        self.__max_pending = max_pending
+        self.__slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, video_file):
+        self.__slots.acquire()
+        try:
+            future = self.__submit(video_file)
+        except BaseException:
+            self.__slots.release()
+            raise
+        future.add_done_callback(functools.partial(self.__done, video_file))
+
+    def wait(self):
+        """
+        Block until every video submitted so far is processed.
+        """
+        for _ in range(self.__max_pending):
+            self.__slots.acquire()
+        for _ in range(self.__max_pending):
+            self.__slots.release()
+
+    def close(self):
+        with self.__lock:
+            self.__executor.shutdown()
+
+    def __submit(self, video_file):
+        with self.__lock:
+            try:
+                return self.__executor.submit(process_one, self.__cmdline,
+                    video_file)
+            except BrokenProcessPool:
+                logging.warning('Processing pool broke, starting a new one')
+                self.__executor = concurrent.futures.ProcessPoolExecutor(
+                    self.__num_workers)
+                return self.__executor.submit(process_one, self.__cmdline,
+                    video_file)
+
+    def __done(self, video_file, future):
+        try:
+            metrics.REGISTRY.merge(future.result())
+        except Exception:
+            logging.exception('Failed to process video file: %s', video_file)
+            metrics.REGISTRY.inc('videos_total', outcome='error')
+        finally:
+            self.__slots.release()
+
+
+class HandoffHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            video_file = line.decode('utf-8').strip()
+            if not video_file:
+                continue
+            logging.info('Received video file: %s', video_file)
+            self.server.stage.submit(video_file)
+            self.wfile.write(b'OK\n')
+
+
+class HandoffServer(socketserver.ThreadingMixIn,
+        socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, stage):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, HandoffHandler)
+        self.stage = stage
+
+
+def send_video(socket_path, video_file):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall(video_file.encode('utf-8') + b'\n')
+        s.shutdown(socket.SHUT_WR)
+        reply = s.makefile('rb').readline()
+    if reply.strip() != b'OK':
+        raise RuntimeError(f'Worker daemon rejected video file {video_file}')
+
+
+def parse_cmdline():
+    p = argparse.ArgumentParser()
+    process.add_processing_options(p)
+    p.add_argument('--socket', required=True,
+        help='Unix socket to receive downloaded files from the crawler.')
+    p.add_argument('--workers', type=int, default=os.cpu_count(),
+        help='Number of processing worker processes.')
+    p.add_argument('--max-pending', type=int,
+        help='Maximum number of videos queued or being processed, '
+            'defaults to twice the number of workers.')
+    metrics.add_metrics_options(p)
+    return p.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    cmdline = parse_cmdline()
+
+    stage = ProcessingStage(cmdline, cmdline.workers,
+        cmdline.max_pending or 2 * cmdline.workers)
+    exporter = metrics.start_exporter(cmdline)
+    server = HandoffServer(cmdline.socket, stage)
+    daemon_pid = os.getpid()
+
+    def stop(signum, frame):
+        # Leave serve_forever() normally, so that the pool finishes the
+        # videos in flight and its workers complete their clip shards.
+        # shutdown() waits for serve_forever() and can't run in its thread.
+        # Workers inherit the handler and ignore the signal, the daemon
+        # shuts them down.
+        if os.getpid() == daemon_pid:
+            threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    logging.info('Listening on %s with %d workers', cmdline.socket,
+        cmdline.workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(cmdline.socket)
+        stage.close()
+        exporter.close()
+
+
+if __name__ == '__main__':
+    main()
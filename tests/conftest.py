@@ -0,0 +1,6 @@
+import os
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+    'src')
+sys.path.insert(0, SRC)
@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+from benchmark import NORMALIZER_ALPHABET, NORMALIZER_PHRASES, vtt_fixtures
+from filter import normalizer, youtube_helpers
+
+
+def random_phrases(seed, count):
+    rng = random.Random(seed)
+    return [''.join(rng.choice(NORMALIZER_ALPHABET)
+        for _ in range(rng.randint(1, 30))) for _ in range(count)]
+
+
+def fixture_phrases():
+    phrases = []
+    for filename in vtt_fixtures():
+        try:
+            phrases.extend(c.text
+                for c in youtube_helpers.load_captions(filename))
+        except ValueError:
+            pass
+    return phrases
+
+
+def check(text):
+    expected = youtube_helpers.normalize_subtitle(text)
+    assert normalizer.normalize(text) == expected
+    for value in (text, expected):
+        assert normalizer.leave_alphanum(value) \
+            == youtube_helpers.leave_alphanum_characters(value)
+
+
+@pytest.mark.parametrize('text', NORMALIZER_PHRASES)
+def test_normalizer_matches_legacy(text):
+    check(text)
+
+
+def test_normalizer_matches_legacy_on_fixtures():
+    for text in fixture_phrases():
+        check(text)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_normalizer_matches_legacy_on_random_phrases(seed):
+    for text in random_phrases(seed, 2000):
+        check(text)
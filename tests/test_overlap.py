@@ -0,0 +1,37 @@
+import contextlib
+import io
+import random
+
+import pytest
+
+import filter
+from benchmark import clean_columns, clean_dicts, outcome, random_captions
+from filter import youtube_helpers
+
+
+def copy(captions):
+    return [filter.Caption(c.start_ms, c.end_ms, c.text, c.idx)
+        for c in captions]
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_captions_match_dicts(seed):
+    rng = random.Random(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(200):
+            captions = random_captions(rng, rng.randint(0, 40))
+            width = rng.randint(0, 5)
+            min_dist, max_dist = rng.choice((0.5, 1.0, 1.5)), rng.randint(2, 15)
+            dicts = [c.to_dict() for c in captions]
+
+            expected = [filter.Caption.from_dict(sub) for sub in
+                youtube_helpers.remove_overlapping_subtitles(dicts, width)]
+            assert youtube_helpers.remove_overlapping_captions(
+                copy(captions), width) == expected
+
+            expected = outcome(clean_dicts, dicts, width, min_dist, max_dist)
+            if expected is not AssertionError:
+                expected = [filter.Caption.from_dict(sub) for sub in expected]
+            for function in (youtube_helpers.clean_captions, clean_columns):
+                assert outcome(function, copy(captions), width, min_dist,
+                    max_dist) == expected
@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+from benchmark import parse_outcome, load_webvtt, vtt_fixtures, \
+    write_synthetic_vtt
+from filter import youtube_helpers
+
+
+@pytest.mark.parametrize('filename', vtt_fixtures(),
+    ids=os.path.basename)
+def test_parser_matches_webvtt(filename):
+    assert parse_outcome(youtube_helpers.load_captions, filename) \
+        == parse_outcome(load_webvtt, filename)
+
+
+@pytest.mark.parametrize('overlap', [0, 0.1, 0.5])
+def test_parser_matches_webvtt_on_synthetic_file(tmp_path, overlap):
+    filename = str(tmp_path / 'synthetic.en.vtt')
+    write_synthetic_vtt(filename, 2000, overlap, seed=1)
+    captions = youtube_helpers.load_captions(filename)
+    assert len(captions) == 2000
+    assert captions == load_webvtt(filename)
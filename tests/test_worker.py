@@ -0,0 +1,62 @@
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+
+import corpus
+import worker
+from benchmark import FAKE_FFMPEG, synthetic_pcm, write_synthetic_vtt
+from conftest import SRC
+
+
+def write_video(directory, video_id, seconds, rng):
+    base = os.path.join(directory, f'{video_id}#Video_{video_id}')
+    with open(base + '.info.json', 'w') as f:
+        f.write(f'{{"id": "{video_id}", "duration": {seconds}}}')
+    write_synthetic_vtt(base + '.en.vtt', seconds * 10 // 39, 0.1,
+        rng.random())
+    with open(base + '.m4a', 'wb') as f:
+        f.write(synthetic_pcm(1, rng.random()) * seconds)
+    return base + '.m4a'
+
+
+def test_sigterm_completes_clip_shards(tmp_path):
+    ffmpeg = tmp_path / 'ffmpeg'
+    ffmpeg.write_text(FAKE_FFMPEG.format(python=sys.executable))
+    ffmpeg.chmod(0o755)
+    dest = tmp_path / 'dest'
+    videos = dest / 'intermediate' / 'channel1'
+    videos.mkdir(parents=True)
+    rng = random.Random(0)
+    files = [write_video(videos, f'video{i}', 60, rng) for i in range(4)]
+
+    socket_path = str(tmp_path / 'worker.sock')
+    daemon = subprocess.Popen([sys.executable,
+        os.path.join(SRC, 'worker.py'), '--socket', socket_path,
+        '--dest', str(dest), '--lang', 'en', '--ffmpeg', str(ffmpeg),
+        '--stream-decode', '--export-clips', '--workers', '2'],
+        start_new_session=True)
+    try:
+        deadline = time.monotonic() + 30
+        while not os.path.exists(socket_path):
+            assert time.monotonic() < deadline
+            assert daemon.poll() is None
+            time.sleep(0.05)
+        for video_file in files:
+            worker.send_video(socket_path, video_file)
+        # Like a service manager stopping the daemon, signal the workers
+        # too, while they still process videos.
+        os.killpg(daemon.pid, signal.SIGTERM)
+        assert daemon.wait(timeout=30) == 0
+    finally:
+        if daemon.poll() is None:
+            os.killpg(daemon.pid, signal.SIGKILL)
+
+    shards = os.listdir(dest / 'corpus')
+    assert shards
+    assert all(name.endswith('.tar') for name in shards)
+    clips = [key for name in shards
+        for key, _ in corpus.read_shard(str(dest / 'corpus' / name))]
+    assert clips